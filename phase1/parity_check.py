@@ -0,0 +1,38 @@
+import os
+import sys
+from tokenizer_p1 import get_filenames, get_text, tokenize
+
+#checks that the fast path of the tokenizer gives the same tokens as BeautifulSoup.
+#with a tokenized directory, the fast path tokens are checked against the files
+#written by an earlier run of tokenizer_p1.py instead, like tokenized_directory
+
+def expected_tokens(file, tokenized_dir):
+    if tokenized_dir is None:
+        return tokenize(get_text(file))
+    tokenized_file = os.path.splitext(os.path.join(tokenized_dir, os.path.basename(file)))[0] + '.txt'
+    with open(tokenized_file, 'r') as f:
+        return f.read().split()
+
+def check_parity(input_dir, tokenized_dir=None):
+    mismatched = []
+    files = sorted(get_filenames(input_dir))
+    for file in files:
+        expected = expected_tokens(file, tokenized_dir)
+        fast = tokenize(get_text(file, fast=True))
+        if fast != expected:
+            #first position where the tokens differ
+            i = next((i for i, (a, b) in enumerate(zip(fast, expected)) if a != b), min(len(fast), len(expected)))
+            print(f'{file}: differs at token {i}, fast {fast[i:i + 5]} expected {expected[i:i + 5]}')
+            mismatched.append(file)
+    print(f'{len(files) - len(mismatched)} of {len(files)} files have the same tokens')
+    return mismatched
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 2:
+        print("Use python3 parity_check.py input-dir [tokenized-dir]")
+        sys.exit(2)
+
+    input_dir = sys.argv[1]
+    tokenized_dir = sys.argv[2] if len(sys.argv) > 2 else None
+    sys.exit(1 if check_parity(input_dir, tokenized_dir) else 0)
@@ -2,8 +2,10 @@ import os
 import sys
 import time
 import re
-import matplotlib.pyplot as plt
-from bs4 import BeautifulSoup
+import codecs
+import multiprocessing
+from html.entities import html5
+from html.parser import HTMLParser
 
 def get_filenames(input_dir):
     filenames = []
@@ -13,53 +15,174 @@ def get_filenames(input_dir):
             filenames.append(f)
     return filenames
 
-def parse(input_dir, output_dir):
-    all_tokens = []
+#text of these tags is left out by BeautifulSoup's get_text()
+HIDDEN_TAGS = {'script', 'style', 'template', 'rt', 'rp'}
+#tags BeautifulSoup closes as soon as they are opened
+VOID_TAGS = {'area', 'base', 'basefont', 'bgsound', 'br', 'col', 'command', 'embed', 'frame', 'hr', 'image',
+             'img', 'input', 'isindex', 'keygen', 'link', 'menuitem', 'meta', 'nextid', 'param', 'source',
+             'spacer', 'track', 'wbr'}
+#named entities without their semicolon, the same way BeautifulSoup looks them up
+ENTITIES = {}
+for name, character in sorted(html5.items()):
+    ENTITIES.setdefault(name.rstrip(';'), character)
+#bytes read from an html file at a time by the fast path
+READ_SIZE = 65536
+
+class TextExtractor(HTMLParser):
+    '''
+    fast path for BeautifulSoup(fp, 'html.parser').get_text(), keeps the text
+    the same way without building the tree. only the names of the open tags
+    are kept to know when the text is inside a hidden tag
+    '''
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.open_tags = []
+        self.hidden = 0 #num of open hidden tags
+        self.pieces = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in VOID_TAGS:
+            return
+        self.open_tags.append(tag)
+        if tag in HIDDEN_TAGS:
+            self.hidden += 1
+
+    def handle_endtag(self, tag):
+        #like BeautifulSoup, closes every tag opened after the last open tag with this name
+        if tag not in self.open_tags:
+            return
+        i = len(self.open_tags) - 1 - self.open_tags[::-1].index(tag)
+        self.hidden -= sum(1 for name in self.open_tags[i:] if name in HIDDEN_TAGS)
+        del self.open_tags[i:]
+
+    def handle_data(self, data):
+        if not self.hidden:
+            self.pieces.append(data)
+
+    def handle_entityref(self, name):
+        self.handle_data(ENTITIES.get(name, f'&{name}'))
+
+    def handle_charref(self, name):
+        code = int(name[1:], 16) if name[:1] in 'xX' else int(name)
+        character = None
+        #references below 256 are read as windows-1252 first, like BeautifulSoup
+        if code < 256:
+            try:
+                character = bytes([code]).decode('windows-1252')
+            except UnicodeDecodeError:
+                pass
+        if character is None:
+            try:
+                character = chr(code)
+            except (ValueError, OverflowError):
+                character = '\ufffd'
+        self.handle_data(character)
+
+    def unknown_decl(self, data):
+        #BeautifulSoup keeps the text of CDATA sections even inside hidden tags
+        if data.upper().startswith('CDATA['):
+            self.pieces.append(data[len('CDATA['):])
+
+def extract_text(file):
+    '''
+    streams the bytes of file through TextExtractor and returns the text
+    '''
+    extractor = TextExtractor()
+    #Deals with UnicodeDecodeError
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+    with open(file, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(READ_SIZE), b''):
+            extractor.feed(decoder.decode(chunk))
+    extractor.feed(decoder.decode(b'', final=True))
+    extractor.close()
+    return ''.join(extractor.pieces)
+
+def get_text(file, fast=False):
+    if fast:
+        return extract_text(file)
+    #imported here so the fast path and the other commands start without it
+    from bs4 import BeautifulSoup
+    #Deals with UnicodeDecodeError
+    with open(file, 'r', encoding='utf-8', errors='ignore') as fp:
+        soup = BeautifulSoup(fp, 'html.parser')
+        return soup.get_text()
+
+#num of processes parsing html and num of files sent to a process at a time
+WORKERS = os.cpu_count() or 1
+CHUNKSIZE = 16
+
+#output directory and text extraction of a worker process, set once by init_worker
+worker_output_dir = None
+worker_fast = False
+
+def init_worker(output_dir, fast=False):
+    global worker_output_dir, worker_fast
+    worker_output_dir = output_dir
+    worker_fast = fast
+
+def tokenize(text):
+    stripped = re.sub(r'[^\sa-zA-Z ]', '\n', text)
+    #only keeps tokens with more than 1 letter or words 'a' and 'i'
+    return [token.lower() for token in stripped.split() if len(token) > 1 or token.lower() in ['a', 'i']]
+
+def tokenize_file(file):
+    '''
+    writes the tokens of file to the output directory and returns their counts
+    '''
+    tokens = tokenize(get_text(file, worker_fast))
+    #joins name of files' path to output directory path. 
+    output_file = os.path.join(worker_output_dir, os.path.basename(file))
+    #removes the .html extension, replaces it with .txt
+    output_file = os.path.splitext(output_file)[0] + '.txt'
+
+    with open(output_file, 'w') as out:
+        for token in tokens:
+            out.write(str(token + '\n'))
+    token_count = {}
+    for token in tokens:
+        token_count[token] = token_count.get(token, 0) + 1
+    return file, token_count
+
+def tokenize_files(files, output_dir, workers=WORKERS, chunksize=CHUNKSIZE, ordered=True, fast=False):
+    '''
+    tokenizes the files in a pool of worker processes, chunksize files at a time.
+    yields (file, token counts) of every file, in the order of files if ordered
+    else as soon as a worker is done with it. fast uses extract_text instead of BeautifulSoup
+    '''
+    if workers <= 1:
+        init_worker(output_dir, fast)
+        yield from map(tokenize_file, files)
+        return
+    with multiprocessing.Pool(workers, init_worker, (output_dir, fast)) as pool:
+        results = pool.imap if ordered else pool.imap_unordered
+        yield from results(tokenize_file, files, chunksize)
+
+def parse(input_dir, output_dir, workers=WORKERS, fast=False, plot=False):
+    token_frequency = {}
     files = get_filenames(input_dir)
     start = time.time()
-    for i, file in enumerate(files):
-        #start = time.time()
-        #Deals with UnicodeDecodeError
-        with open(file, 'r', encoding='utf-8', errors='ignore') as fp:
-            soup = BeautifulSoup(fp, 'html.parser')
-            text = soup.get_text()
-
-            stripped = re.sub(r'[^\sa-zA-Z ]', '\n', text)
-            #only keeps tokens with more than 1 letter or words 'a' and 'i'
-            tokens = [token.lower() for token in stripped.split() if len(token) > 1 or token.lower() in ['a', 'i']]
-            #joins name of files' path to output directory path. 
-            output_file = os.path.join(output_dir, os.path.basename(file))
-            #removes the .html extension, replaces it with .txt
-            output_file = os.path.splitext(output_file)[0] + '.txt'
-
-            with open(output_file, 'w') as out:
-                for token in tokens:
-                    out.write(str(token + '\n'))
-            all_tokens += tokens
-            #end = time.time()
-            #all_time.append(end-start)
+    #counts are merged in the order of the files so tokens with the same frequency keep their order
+    for i, (file, token_count) in enumerate(tokenize_files(files, output_dir, workers, fast=fast)):
+        for token, amount in token_count.items():
+            token_frequency[token] = token_frequency.get(token, 0) + amount
         if i % 100 == 0:
             print(f'Number of files processed: {i + 1} ')
-    frequency_count(all_tokens)
+    frequency_count(token_frequency)
     end = time.time()
     time_taken = (end - start) * 1000 #convert to milliseconds
     print(f'Time taken is ~ {time_taken} milliseconds')
-    plt.plot([0, len(files)], [0, time_taken])
-    plt.xlabel('Number of Files')
-    plt.ylabel('Time taken(ms)')
-    plt.show()
+    if plot:
+        import matplotlib.pyplot as plt
+        plt.plot([0, len(files)], [0, time_taken])
+        plt.xlabel('Number of Files')
+        plt.ylabel('Time taken(ms)')
+        plt.show()
+    return time_taken
 
-#function that counts frequency of tokens. Will create two files,
+#function that writes the frequency of tokens counted by parse. Will create two files,
 #one where tokens are sorted by frequency. The second, where
 #tokens are sorted alphabetically. Both files will contain frequency of each token.
-def frequency_count(tokens):
-    token_frequency = {}
-    for token in tokens:
-        if token not in token_frequency:
-            token_frequency[token] = 1
-        else:
-            token_frequency[token] += 1
-
+def frequency_count(token_frequency):
     sorted_by_frequency = sorted(token_frequency.items(), key=lambda x: x[1], reverse=True)
     #print(type(sorted_by_frequency))
     with open('sorted_by_frequency.txt', 'w') as out:
@@ -74,10 +197,15 @@ def frequency_count(tokens):
 
 if __name__ == "__main__":
 
-    if len(sys.argv) < 2:
-        print("Use python3 tokenizer_p1.py input-dir output-dir")
+    #--fast skips building the BeautifulSoup tree, --plot shows the time taken in a window
+    fast = '--fast' in sys.argv
+    plot = '--plot' in sys.argv
+    args = [arg for arg in sys.argv if arg not in ('--fast', '--plot')]
+    if len(args) < 2:
+        print("Use python3 tokenizer_p1.py input-dir output-dir [workers] [--fast] [--plot]")
 
-    input_dir = sys.argv[1]
-    output_dir = sys.argv[2]
+    input_dir = args[1]
+    output_dir = args[2]
+    workers = int(args[3]) if len(args) > 3 else WORKERS
 
-    parse(input_dir, output_dir)
\ No newline at end of file
+    parse(input_dir, output_dir, workers, fast, plot)
\ No newline at end of file
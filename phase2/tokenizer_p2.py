@@ -3,9 +3,11 @@ import sys
 import time
 import re
 import math
+import codecs
+import multiprocessing
+from html.entities import html5
+from html.parser import HTMLParser
 from collections import defaultdict
-import matplotlib.pyplot as plt
-from bs4 import BeautifulSoup
 
 def get_filenames(input_dir):
     filenames = []
@@ -16,7 +18,140 @@ def get_filenames(input_dir):
     return filenames
 
 
-def parse(input_dir, output_dir, stop_words_set):
+#text of these tags is left out by BeautifulSoup's get_text()
+HIDDEN_TAGS = {'script', 'style', 'template', 'rt', 'rp'}
+#tags BeautifulSoup closes as soon as they are opened
+VOID_TAGS = {'area', 'base', 'basefont', 'bgsound', 'br', 'col', 'command', 'embed', 'frame', 'hr', 'image',
+             'img', 'input', 'isindex', 'keygen', 'link', 'menuitem', 'meta', 'nextid', 'param', 'source',
+             'spacer', 'track', 'wbr'}
+#named entities without their semicolon, the same way BeautifulSoup looks them up
+ENTITIES = {}
+for name, character in sorted(html5.items()):
+    ENTITIES.setdefault(name.rstrip(';'), character)
+#bytes read from an html file at a time by the fast path
+READ_SIZE = 65536
+
+class TextExtractor(HTMLParser):
+    '''
+    fast path for BeautifulSoup(fp, 'html.parser').get_text(), keeps the text
+    the same way without building the tree. only the names of the open tags
+    are kept to know when the text is inside a hidden tag
+    '''
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.open_tags = []
+        self.hidden = 0 #num of open hidden tags
+        self.pieces = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in VOID_TAGS:
+            return
+        self.open_tags.append(tag)
+        if tag in HIDDEN_TAGS:
+            self.hidden += 1
+
+    def handle_endtag(self, tag):
+        #like BeautifulSoup, closes every tag opened after the last open tag with this name
+        if tag not in self.open_tags:
+            return
+        i = len(self.open_tags) - 1 - self.open_tags[::-1].index(tag)
+        self.hidden -= sum(1 for name in self.open_tags[i:] if name in HIDDEN_TAGS)
+        del self.open_tags[i:]
+
+    def handle_data(self, data):
+        if not self.hidden:
+            self.pieces.append(data)
+
+    def handle_entityref(self, name):
+        self.handle_data(ENTITIES.get(name, f'&{name}'))
+
+    def handle_charref(self, name):
+        code = int(name[1:], 16) if name[:1] in 'xX' else int(name)
+        character = None
+        #references below 256 are read as windows-1252 first, like BeautifulSoup
+        if code < 256:
+            try:
+                character = bytes([code]).decode('windows-1252')
+            except UnicodeDecodeError:
+                pass
+        if character is None:
+            try:
+                character = chr(code)
+            except (ValueError, OverflowError):
+                character = '\ufffd'
+        self.handle_data(character)
+
+    def unknown_decl(self, data):
+        #BeautifulSoup keeps the text of CDATA sections even inside hidden tags
+        if data.upper().startswith('CDATA['):
+            self.pieces.append(data[len('CDATA['):])
+
+def extract_text(file):
+    '''
+    streams the bytes of file through TextExtractor and returns the text
+    '''
+    extractor = TextExtractor()
+    #Deals with UnicodeDecodeError
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+    with open(file, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(READ_SIZE), b''):
+            extractor.feed(decoder.decode(chunk))
+    extractor.feed(decoder.decode(b'', final=True))
+    extractor.close()
+    return ''.join(extractor.pieces)
+
+def get_text(file, fast=False):
+    if fast:
+        return extract_text(file)
+    #imported here so the fast path and the other commands start without it
+    from bs4 import BeautifulSoup
+    #Deals with UnicodeDecodeError
+    with open(file, 'r', encoding='utf-8', errors='ignore') as fp:
+        soup = BeautifulSoup(fp, 'html.parser')
+        return soup.get_text()
+
+#num of processes parsing html and num of files sent to a process at a time
+WORKERS = os.cpu_count() or 1
+CHUNKSIZE = 16
+
+#stop words and text extraction of a worker process, set once by init_worker instead of sent with every file
+worker_stop_words = set()
+worker_fast = False
+
+def init_worker(stop_words_set, fast=False):
+    global worker_stop_words, worker_fast
+    worker_stop_words = stop_words_set
+    worker_fast = fast
+
+def count_tokens(file):
+    text = get_text(file, worker_fast)
+    stripped = re.findall(r'\b[a-zA-Z]+\b', text.lower())
+
+    #The two lines below are how I stripped tokens in the Phase 1 of the project
+    #stripped = re.sub(r'[^\sa-zA-Z ]', '\n', text)
+    #tokens = [token.lower() for token in stripped.split() if len(token) > 1 and token.lower() not in stop_words_list]
+    tokens = [token for token in stripped if token not in worker_stop_words and len(token) > 1]
+    token_count = {}
+    for token in tokens:
+        token_count[token] = token_count.get(token, 0) + 1
+    return file, token_count
+
+def tokenize_files(files, stop_words_set, workers=WORKERS, chunksize=CHUNKSIZE, ordered=True, fast=False):
+    '''
+    parses and tokenizes the files in a pool of worker processes, chunksize
+    files at a time. yields (file, token counts) of every file, in the order of
+    files if ordered else as soon as a worker is done with it. fast uses
+    extract_text instead of BeautifulSoup
+    '''
+    if workers <= 1:
+        init_worker(stop_words_set, fast)
+        yield from map(count_tokens, files)
+        return
+    with multiprocessing.Pool(workers, init_worker, (stop_words_set, fast)) as pool:
+        results = pool.imap if ordered else pool.imap_unordered
+        yield from results(count_tokens, files, chunksize)
+
+def parse(input_dir, output_dir, stop_words_set, workers=WORKERS, fast=False, plot=False):
     files = get_filenames(input_dir)
     files_length = len(files)
     #used to store token frequency and avoids checks for existence of a key in a dict
@@ -24,35 +159,24 @@ def parse(input_dir, output_dir, stop_words_set):
     token_freq = {}
     document_freq = defaultdict(int)
     start = time.time()
-    for i, file in enumerate(files):
-        #Deals with UnicodeDecodeError
-        with open(file, 'r', encoding='utf-8', errors='ignore') as fp:
-            soup = BeautifulSoup(fp, 'html.parser')
-            text = soup.get_text()
-
-            stripped = re.findall(r'\b[a-zA-Z]+\b', text.lower())
-
-            #The two lines below are how I stripped tokens in the Phase 1 of the project
-            #stripped = re.sub(r'[^\sa-zA-Z ]', '\n', text)
-            #tokens = [token.lower() for token in stripped.split() if len(token) > 1 and token.lower() not in stop_words_list]
-            tokens = [token for token in stripped if token not in stop_words_set and len(token) > 1]
-            for token in tokens:
-                if token not in token_freq:
-                    #create empty inner dict if token has not been encountered
-                    token_freq[token] = {} 
-                if file not in token_freq[token]:
-                    token_freq[token][file] = 0  #default value is 0
-                token_freq[token][file] += 1
-            
-            #used a set to not count duplicates as it resulted in negative TF-IDF
-            #keeps track of num of documents contain a certain token
-            for token in set(tokens):
-                document_freq[token]+=1
-
-            #METHOD 1 of removing tokens that appear once in corpus
-            # appear_once = [token for token in token_freq if document_freq[token] == 1]
-            # for token in appear_once:
-            #     del token_freq[token]
+    #the weights of a file depend on the files before it so results are kept in order
+    for i, (file, token_count) in enumerate(tokenize_files(files, stop_words_set, workers, fast=fast)):
+        num_tokens = sum(token_count.values())
+        for token, amount in token_count.items():
+            if token not in token_freq:
+                #create empty inner dict if token has not been encountered
+                token_freq[token] = {} 
+            token_freq[token][file] = amount
+
+        #token_count holds every token once, counting duplicates resulted in negative TF-IDF
+        #keeps track of num of documents contain a certain token
+        for token in token_count:
+            document_freq[token]+=1
+
+        #METHOD 1 of removing tokens that appear once in corpus
+        # appear_once = [token for token in token_freq if document_freq[token] == 1]
+        # for token in appear_once:
+        #     del token_freq[token]
 
         output_file = os.path.join(output_dir, os.path.basename(file))
         #removes the .html extension, replaces it with .wts
@@ -66,7 +190,7 @@ def parse(input_dir, output_dir, stop_words_set):
                     #Not sure if this is the correct way to not count tokens that occur once in entire corpus
                     if document_freq[token] == 1:
                         continue
-                    tf = token_freq[token][file] / len(tokens)
+                    tf = token_freq[token][file] / num_tokens
                     idf = math.log(files_length / document_freq[token])
                     tf_idf = tf*idf
                     out.write(f'{token} \t {tf_idf}\n')
@@ -77,22 +201,30 @@ def parse(input_dir, output_dir, stop_words_set):
     end = time.time()
     time_taken = (end - start) * 1000 #convert to milliseconds
     print(f'Time taken is ~ {time_taken} milliseconds')
-    plt.plot([0, i], [0, time_taken])
-    plt.xlabel('Number of Files')
-    plt.ylabel('Time taken(ms)')
-    plt.show()
+    if plot:
+        import matplotlib.pyplot as plt
+        plt.plot([0, i], [0, time_taken])
+        plt.xlabel('Number of Files')
+        plt.ylabel('Time taken(ms)')
+        plt.show()
+    return time_taken
 
 if __name__ == "__main__":
 
-    if len(sys.argv) < 2:
-        print("Use python3 tokenizer_p1.py input-dir output-dir")
+    #--fast skips building the BeautifulSoup tree, --plot shows the time taken in a window
+    fast = '--fast' in sys.argv
+    plot = '--plot' in sys.argv
+    args = [arg for arg in sys.argv if arg not in ('--fast', '--plot')]
+    if len(args) < 2:
+        print("Use python3 tokenizer_p2.py input-dir output-dir [workers] [--fast] [--plot]")
 
-    input_dir = sys.argv[1]
-    output_dir = sys.argv[2]
+    input_dir = args[1]
+    output_dir = args[2]
+    workers = int(args[3]) if len(args) > 3 else WORKERS
 
     #reads in stop words
     with open('stopwords.txt', 'r') as f:
         stop_words_set = {line.strip() for line in f}
     #print(type(stop_words_set))
     #print(len(stop_words_set))
-    parse(input_dir, output_dir, stop_words_set)
\ No newline at end of file
+    parse(input_dir, output_dir, stop_words_set, workers, fast, plot)
\ No newline at end of file
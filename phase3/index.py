@@ -3,9 +3,18 @@ import sys
 import time
 import re
 import math
+import heapq
+import struct
+import codecs
+import tempfile
+import multiprocessing
+from contextlib import ExitStack
+from html.entities import html5
+from html.parser import HTMLParser
+from array import array
+from itertools import accumulate
 from collections import defaultdict
-import matplotlib.pyplot as plt
-from bs4 import BeautifulSoup
+import metrics
 
 def get_filenames(input_dir):
     filenames = []
@@ -16,84 +25,700 @@ def get_filenames(input_dir):
     return filenames
 
 
-def parse(input_dir, stop_words_set):
+#text of these tags is left out by BeautifulSoup's get_text()
+HIDDEN_TAGS = {'script', 'style', 'template', 'rt', 'rp'}
+#tags BeautifulSoup closes as soon as they are opened
+VOID_TAGS = {'area', 'base', 'basefont', 'bgsound', 'br', 'col', 'command', 'embed', 'frame', 'hr', 'image',
+             'img', 'input', 'isindex', 'keygen', 'link', 'menuitem', 'meta', 'nextid', 'param', 'source',
+             'spacer', 'track', 'wbr'}
+#named entities without their semicolon, the same way BeautifulSoup looks them up
+ENTITIES = {}
+for name, character in sorted(html5.items()):
+    ENTITIES.setdefault(name.rstrip(';'), character)
+#bytes read from an html file at a time by the fast path
+READ_SIZE = 65536
 
+class TextExtractor(HTMLParser):
+    '''
+    fast path for BeautifulSoup(fp, 'html.parser').get_text(), keeps the text
+    the same way without building the tree. only the names of the open tags
+    are kept to know when the text is inside a hidden tag
+    '''
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.open_tags = []
+        self.hidden = 0 #num of open hidden tags
+        self.pieces = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in VOID_TAGS:
+            return
+        self.open_tags.append(tag)
+        if tag in HIDDEN_TAGS:
+            self.hidden += 1
+
+    def handle_endtag(self, tag):
+        #like BeautifulSoup, closes every tag opened after the last open tag with this name
+        if tag not in self.open_tags:
+            return
+        i = len(self.open_tags) - 1 - self.open_tags[::-1].index(tag)
+        self.hidden -= sum(1 for name in self.open_tags[i:] if name in HIDDEN_TAGS)
+        del self.open_tags[i:]
+
+    def handle_data(self, data):
+        if not self.hidden:
+            self.pieces.append(data)
+
+    def handle_entityref(self, name):
+        self.handle_data(ENTITIES.get(name, f'&{name}'))
+
+    def handle_charref(self, name):
+        code = int(name[1:], 16) if name[:1] in 'xX' else int(name)
+        character = None
+        #references below 256 are read as windows-1252 first, like BeautifulSoup
+        if code < 256:
+            try:
+                character = bytes([code]).decode('windows-1252')
+            except UnicodeDecodeError:
+                pass
+        if character is None:
+            try:
+                character = chr(code)
+            except (ValueError, OverflowError):
+                character = '\ufffd'
+        self.handle_data(character)
+
+    def unknown_decl(self, data):
+        #BeautifulSoup keeps the text of CDATA sections even inside hidden tags
+        if data.upper().startswith('CDATA['):
+            self.pieces.append(data[len('CDATA['):])
+
+def extract_text(file):
+    '''
+    streams the bytes of file through TextExtractor and returns the text
+    '''
+    extractor = TextExtractor()
+    #Deals with UnicodeDecodeError
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+    with open(file, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(READ_SIZE), b''):
+            extractor.feed(decoder.decode(chunk))
+    extractor.feed(decoder.decode(b'', final=True))
+    extractor.close()
+    return ''.join(extractor.pieces)
+
+def get_text(file, fast=False):
+    if fast:
+        return extract_text(file)
+    #imported here so the fast path and the other commands start without it
+    from bs4 import BeautifulSoup
+    #Deals with UnicodeDecodeError
+    with open(file, 'r', encoding='utf-8', errors='ignore') as fp:
+        soup = BeautifulSoup(fp, 'html.parser')
+        return soup.get_text()
+
+#bytes of memory the postings buffer may use before it is written to a run on disk
+MEMORY_BUDGET = 256 * 1024 * 1024
+#num of processes parsing html and num of files sent to a process at a time
+WORKERS = os.cpu_count() or 1
+CHUNKSIZE = 16
+
+def tokenize(file, stop_words_set, fast=False):
+    with metrics.timer('html_parse'):
+        text = get_text(file, fast)
+    with metrics.timer('regex_tokenize'):
+        stripped = re.findall(r'\b[a-zA-Z]+\b', text.lower())
+    with metrics.timer('stopword_filter'):
+        return [token for token in stripped if token not in stop_words_set and len(token) > 1]
+
+def tokenize_positions(file, stop_words_set, fast=False):
+    '''
+    positions of every token of a doc. every word counts for the position, stop
+    words too, so a phrase with a stop word in the middle keeps its gap
+    '''
+    with metrics.timer('html_parse'):
+        text = get_text(file, fast)
+    with metrics.timer('regex_tokenize'):
+        stripped = re.findall(r'\b[a-zA-Z]+\b', text.lower())
+    token_positions = defaultdict(lambda: array('i'))
+    with metrics.timer('stopword_filter'):
+        for position, token in enumerate(stripped):
+            if token not in stop_words_set and len(token) > 1:
+                token_positions[token].append(position)
+    return token_positions
+
+#stop words and text extraction of a worker process, set once by init_worker instead of sent with every file
+worker_stop_words = set()
+worker_fast = False
+worker_positions = False
+
+def init_worker(stop_words_set, fast=False, measure=False, positions=False):
+    global worker_stop_words, worker_fast, worker_positions
+    worker_stop_words = stop_words_set
+    worker_fast = fast
+    worker_positions = positions
+    metrics.enable(measure)
+
+def count_tokens(file):
+    '''
+    (file, tf of every token), or the positions of every token for a positional index
+    '''
+    if worker_positions:
+        token_positions = tokenize_positions(file, worker_stop_words, worker_fast)
+        metrics.observe('doc_tokens', sum(len(positions) for positions in token_positions.values()))
+        return file, dict(token_positions)
+    token_count = defaultdict(int)
+    tokens = tokenize(file, worker_stop_words, worker_fast)
+    for token in tokens:
+        token_count[token] += 1
+    metrics.observe('doc_tokens', len(tokens))
+    return file, dict(token_count)
+
+def count_tokens_measured(file):
+    #metrics of a worker process go back to the main process with every file
+    return count_tokens(file), metrics.take()
+
+def tokenize_files(files, stop_words_set, workers=WORKERS, chunksize=CHUNKSIZE, ordered=True, fast=False, positions=False):
+    '''
+    parses and tokenizes the files in a pool of worker processes, chunksize
+    files at a time. yields (file, token counts) of every file, in the order of
+    files if ordered else as soon as a worker is done with it. fast uses
+    extract_text instead of BeautifulSoup, with positions the token counts are
+    arrays of the positions of the tokens
+    '''
+    if workers <= 1:
+        init_worker(stop_words_set, fast, metrics.enabled, positions)
+        yield from map(count_tokens, files)
+        return
+    with multiprocessing.Pool(workers, init_worker, (stop_words_set, fast, metrics.enabled, positions)) as pool:
+        results = pool.imap if ordered else pool.imap_unordered
+        if not metrics.enabled:
+            yield from results(count_tokens, files, chunksize)
+            return
+        for result, recorded in results(count_tokens_measured, files, chunksize):
+            metrics.merge(recorded)
+            yield result
+
+#estimated bytes used in the buffer by a posting (doc id and tf in an int array)
+#and by a token (its string, dict entry and array)
+POSTING_SIZE = 8
+TOKEN_SIZE = 160
+#max num of runs merged at once, more runs are first merged into bigger runs
+MAX_FAN_IN = 64
+#bytes of the read and write buffers of a run file
+RUN_BUFFER = 1024 * 1024
+RUN_RECORD = struct.Struct('<HI') #token length, num of ints in the postings
+
+def little_endian(values):
+    #files are always little endian so they can be copied between machines
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values
+
+def write_record(f, token, postings):
+    term = token.encode('utf-8')
+    f.write(RUN_RECORD.pack(len(term), len(postings)))
+    f.write(term)
+    little_endian(postings).tofile(f)
+
+def write_run(run_file, stream):
+    '''
+    writes a stream of (token, postings) sorted by token to a binary run,
+    postings are flat int32 doc_id, tf pairs
+    '''
+    with open(run_file, 'wb', buffering=RUN_BUFFER) as f:
+        for token, postings in stream:
+            write_record(f, token, postings)
+
+def read_run(run_file):
+    with open(run_file, 'rb', buffering=RUN_BUFFER) as f:
+        while True:
+            record = f.read(RUN_RECORD.size)
+            if not record:
+                break
+            term_length, num_ints = RUN_RECORD.unpack(record)
+            token = f.read(term_length).decode('utf-8')
+            postings = array('i')
+            postings.frombytes(f.read(4 * num_ints))
+            yield token, little_endian(postings)
+
+def parse(input_dir, stop_words_set, run_dir, memory_budget=MEMORY_BUDGET, workers=WORKERS, fast=False, positions=False):
+    '''
+    single pass over the documents, which are tokenized by a pool of worker processes.
+    documents get dense integer ids in the order they are parsed and their postings
+    are buffered per token as flat doc_id, tf pairs. once the buffer is estimated to
+    use memory_budget bytes it is written to a sorted run in run_dir. returns the blocks
+    (run files and the last buffer) for merge_postings and docs holding (file, num of tokens)
+    of every doc id. with positions, the tf of a posting is followed by the tf positions
+    of the token in the doc
+    '''
     files = input_dir
-    #used to store token frequency and avoids checks for existence of a key in a dict
-    #outer dictionary are tokens, values of the tokens are in the inner
-    token_freq = {}
-    document_freq = defaultdict(int)
-    for file in files:
-        #Deals with UnicodeDecodeError
-        with open(file, 'r', encoding='utf-8', errors='ignore') as fp:
-            soup = BeautifulSoup(fp, 'html.parser')
-            text = soup.get_text()
-
-            stripped = re.findall(r'\b[a-zA-Z]+\b', text.lower())
-
-            tokens = [token for token in stripped if token not in stop_words_set and len(token) > 1]
-            for token in tokens:
-                if token not in token_freq:
-                    #create empty inner dict if token has not been encountered
-                    token_freq[token] = {} 
-                if file not in token_freq[token]:
-                    token_freq[token][file] = 0  #default value is 0
-                token_freq[token][file] += 1
-            
-            #used a set to not count duplicates as it resulted in negative TF-IDF
-            #keeps track of num of documents contain a certain token
-            for token in set(tokens):
-                document_freq[token]+=1
-
-            #removing tokens that appear once in corpus
-            appear_once = [token for token in token_freq if document_freq[token] == 1]
-            for token in appear_once:
-                del token_freq[token]
-    return token_freq, document_freq
-
-
-def inverted_index(token_freq, doc_freq, output_dir):
-    dict_file = os.path.join(output_dir, "dictionary.txt")
-    post_file = os.path.join(output_dir, "postings.txt")
-
-    #for calc docs length
-    doc_lengths = {}
-    #docs is another dict that contains token freq of current token in each document
-    for token, docs in token_freq.items():
-        #weight is token frequency of current token in current document
-        for file, weight in docs.items():
-            if file not in doc_lengths:
-                doc_lengths[file] = 0
-            doc_lengths[file] += weight ** 2
+    buffer = defaultdict(lambda: array('i'))
+    buffered = 0 #estimated bytes used by the buffer
+    runs = []
+    docs = []
+    #doc ids follow the order of files so every build of the same files numbers them the same
+    tokenized = tokenize_files(files, stop_words_set, workers, fast=fast, positions=positions)
+    for doc_id, (file, token_count) in enumerate(tokenized):
+        if positions:
+            num_positions = sum(len(token_positions) for token_positions in token_count.values())
+            docs.append((file, num_positions))
+            buffered += 4 * num_positions
+        else:
+            docs.append((file, sum(token_count.values())))
+        #tokens of a single document are counted before going in the buffer
+        for token, tf in token_count.items():
+            if token not in buffer:
+                buffered += TOKEN_SIZE + len(token)
+            if positions:
+                buffer[token].extend((doc_id, len(tf)))
+                buffer[token].extend(tf)
+            else:
+                buffer[token].extend((doc_id, tf))
+        buffered += POSTING_SIZE * len(token_count)
+
+        if buffered >= memory_budget:
+            run_file = os.path.join(run_dir, f'run_{len(runs)}.bin')
+            with metrics.timer('run_write'):
+                write_run(run_file, ((token, buffer[token]) for token in sorted(buffer)))
+            metrics.count('runs_written')
+            runs.append(run_file)
+            buffer = defaultdict(lambda: array('i'))
+            buffered = 0
+    metrics.count('docs_parsed', len(docs))
+    #runs are merged down to MAX_FAN_IN so the final merge does not open too many files
+    merge_pass = 0
+    while len(runs) >= MAX_FAN_IN:
+        merge_pass += 1
+        merged = []
+        for i in range(0, len(runs), MAX_FAN_IN):
+            group = runs[i:i + MAX_FAN_IN]
+            if len(group) == 1:
+                merged.extend(group)
+                continue
+            run_file = os.path.join(run_dir, f'merge_{merge_pass}_{len(merged)}.bin')
+            #df==1 tokens can only be removed once every run is merged
+            with metrics.timer('run_merge'):
+                write_run(run_file, merge_postings(group, prune=False))
+            for run in group:
+                os.remove(run)
+            merged.append(run_file)
+        runs = merged
+    return runs + [buffer], docs
+
+def in_many_docs(postings, positions=False):
+    #postings of a positional index have the positions of the first doc after its tf
+    return len(postings) > (2 + postings[1] if positions else 2)
+
+def merge_postings(blocks, prune=True, pruned=None, positions=False):
+    '''
+    k-way merge of the blocks from parse into one stream of (token, postings)
+    sorted by token, only one record of each block is in memory at a time.
+    blocks are in the order they were written so the doc ids stay increasing.
+    tokens that appear in only one document of the corpus are removed here, once,
+    and passed to pruned if it is given
+    '''
+    streams = []
+    for block in blocks:
+        if isinstance(block, str):
+            streams.append(read_run(block))
+        else:
+            streams.append((token, block[token]) for token in sorted(block))
+    keep = lambda postings: not prune or in_many_docs(postings, positions)
+    current, postings = None, array('i')
+    #heapq.merge is stable, equal tokens come out in block order
+    for token, block_postings in heapq.merge(*streams, key=lambda x: x[0]):
+        if token != current:
+            if current is not None and keep(postings):
+                yield current, postings
+            elif current is not None and pruned is not None:
+                pruned(current, postings)
+            current, postings = token, array('i')
+        postings.extend(block_postings)
+    if current is not None and keep(postings):
+        yield current, postings
+    elif current is not None and pruned is not None:
+        pruned(current, postings)
+
+def split_positions(postings):
+    '''
+    doc_id, tf pairs and the positions of every posting one after the other, from
+    postings where the positions of a posting follow its tf
+    '''
+    pairs = array('i')
+    positions = array('i')
+    i = 0
+    while i < len(postings):
+        tf = postings[i + 1]
+        pairs.extend((postings[i], tf))
+        positions.extend(postings[i + 2:i + 2 + tf])
+        i += 2 + tf
+    return pairs, positions
+
+
+#binary index layout, phase4 memory maps these files
+#lexicon.bin: header, then for every block of LEXICON_BLOCK terms sorted by term its byte offset
+#and where the postings of its first term start in both columns of postings.bin, then the blocks.
+#every term of a block is front coded, the num of bytes it shares with the term before it in the
+#block and the rest of it, followed by its num of postings, the bytes of its doc ids and its max
+#weight. numbers are variable byte encoded and the max weight is a float64, where the postings of a
+#term start is found by adding up the terms before it. phase4 binary searches the first terms
+#postings.bin: header, the weights of every posting, then the doc ids of every posting.
+#the weight is tf / norm of the doc, phase4 multiplies it by the idf of the token at query time
+#so segments added by update.py share the idf of the whole index. weights are float32 or
+#quantized to 16 or 8 bits. doc ids of a token are gaps from the doc id before, variable byte
+#encoded, the lexicon entry has where the doc ids of the token start and how many bytes they are,
+#and the max weight of the token so phase4 can skip docs that cannot make it to the top k
+#docs.txt: one line per doc id with the file name, num of tokens and norm separated by tabs
+#pruned.bin: postings of the tokens that appear in only one document, in the format of the
+#runs. queries do not use them, update.py compact needs them to merge segments
+#tf.bin: only written by builds with quantized weights and without positions. magic, then
+#the tf of every posting in the order of the weights of postings.bin as variable byte
+#numbers, mostly a byte each. a quantized weight does not give its tf back, update.py
+#compact reads the tf from here instead
+#positions.bin: only written by builds with positions, so plain queries never read it.
+#header, the byte offset of the block of every term in lexicon order and one past the last,
+#then the blocks. a block has a skip table with the offset of every POSITIONS_SKIP-th
+#posting after the table, then for every posting its num of positions, the bytes of its
+#positions and the positions as variable byte gaps, so a query jumps to a posting
+#through the skip table and skips the postings after it by their bytes
+LEXICON_MAGIC = b'LEX4'
+POSTINGS_MAGIC = b'PST2'
+POSITIONS_MAGIC = b'POS1'
+TF_MAGIC = b'TF01'
+LEXICON_HEADER = struct.Struct('<4sII') #magic, num of terms, terms per block
+LEXICON_BLOCK = 16
+#byte offset of a block after the block table, start pos in postings and doc ids offset of its first term
+LEXICON_BLOCK_ENTRY = struct.Struct('<QQQ')
+MAX_WEIGHT = struct.Struct('<d')
+#magic, bits of a weight, num of postings, min weight, log of max weight / min weight
+POSTINGS_HEADER = struct.Struct('<4sB3xQdd')
+WEIGHT_BITS = 32
+WEIGHT_TYPES = {32: 'f', 16: 'H', 8: 'B'}
+POSITIONS_HEADER = struct.Struct('<4sII') #magic, postings per skip, num of terms
+POSITIONS_SKIP = 32
+#segments.txt: the segments of an index updated by update.py, one line per segment dir
+#with its num of docs. doc ids of a segment start after the docs of the segments before it
+#tombstones.txt: deleted docs, one line per doc with its segment dir and doc id in the segment
+MANIFEST = 'segments.txt'
+TOMBSTONES = 'tombstones.txt'
+
+def write_docs(docs_file, docs, doc_lengths):
+    with open(docs_file, 'w') as f:
+        for (file, length), norm in zip(docs, doc_lengths):
+            #extract just name of filename from the path
+            f.write(f'{os.path.basename(file)}\t{length}\t{norm}\n')
+
+def encode_gaps(doc_ids, out):
+    '''
+    appends increasing doc ids to out as gaps from the doc id before, 7 bits
+    a byte with the high bit set on every byte of a gap but the last
+    '''
+    last = 0
+    for doc_id in doc_ids:
+        gap = doc_id - last
+        last = doc_id
+        while gap >= 128:
+            out.append(gap & 127 | 128)
+            gap >>= 7
+        out.append(gap)
+
+def decode_gaps(data, num_postings):
+    if len(data) == num_postings:
+        #every gap fits in one byte, the common case for frequent tokens
+        return accumulate(data)
+    doc_ids = array('i')
+    doc_id, gap, shift = 0, 0, 0
+    for byte in data:
+        if byte & 128:
+            gap |= (byte & 127) << shift
+            shift += 7
+        else:
+            doc_id += gap | byte << shift
+            doc_ids.append(doc_id)
+            gap, shift = 0, 0
+    return doc_ids
+
+def encode_positions(pairs, positions, out):
+    '''
+    appends the block of a term to out, pairs are its doc_id, tf pairs and positions
+    the positions of every posting one after the other
+    '''
+    body = bytearray()
+    skips = array('I')
+    at = 0
+    for n, tf in enumerate(pairs[1::2]):
+        if n % POSITIONS_SKIP == 0:
+            skips.append(len(body))
+        gaps = bytearray()
+        encode_gaps(positions[at:at + tf], gaps)
+        at += tf
+        #a single number is its own gap
+        encode_gaps((tf,), body)
+        encode_gaps((len(gaps),), body)
+        body += gaps
+    out += little_endian(skips).tobytes()
+    out += body
+
+def encode_numbers(numbers, out):
+    #appends every number to out as a variable byte number
+    if max(numbers, default=0) < 128:
+        out += array('B', numbers)
+        return
+    for number in numbers:
+        while number >= 128:
+            out.append(number & 127 | 128)
+            number >>= 7
+        out.append(number)
+
+def decode_numbers(data, i, count):
+    '''
+    (count variable byte numbers from i, index after them)
+    '''
+    if not any(byte & 128 for byte in data[i:i + count]):
+        return array('i', array('B', data[i:i + count])), i + count
+    numbers = array('i')
+    for _ in range(count):
+        number, i = read_number(data, i)
+        numbers.append(number)
+    return numbers, i
+
+def read_number(data, i):
+    '''
+    (variable byte number at i, index after it)
+    '''
+    number, shift = 0, 0
+    while data[i] & 128:
+        number |= (data[i] & 127) << shift
+        shift += 7
+        i += 1
+    return number | data[i] << shift, i + 1
+
+def decode_positions(block, num_postings):
+    '''
+    positions of every posting of a term block from positions.bin
+    '''
+    i = 4 * ((num_postings + POSITIONS_SKIP - 1) // POSITIONS_SKIP)
+    positions = []
+    for _ in range(num_postings):
+        tf, i = read_number(block, i)
+        length, i = read_number(block, i)
+        positions.append(array('i', decode_gaps(block[i:i + length], tf)))
+        i += length
+    return positions
+
+def read_lexicon(data):
+    '''
+    yields (term, num of postings, start pos in postings, doc ids offset, doc ids bytes,
+    max weight) of every term of lexicon.bin in term order
+    '''
+    _, num_terms, block_size = LEXICON_HEADER.unpack_from(data, 0)
+    num_blocks = (num_terms + block_size - 1) // block_size
+    i = LEXICON_HEADER.size + LEXICON_BLOCK_ENTRY.size * num_blocks
+    for n in range(num_terms):
+        if n % block_size == 0:
+            _, start, docs_offset = LEXICON_BLOCK_ENTRY.unpack_from(data, LEXICON_HEADER.size +
+                                                                    LEXICON_BLOCK_ENTRY.size * (n // block_size))
+            term = b''
+        shared, i = read_number(data, i)
+        length, i = read_number(data, i)
+        term = term[:shared] + data[i:i + length]
+        doc_freq, i = read_number(data, i + length)
+        docs_length, i = read_number(data, i)
+        max_weight, = MAX_WEIGHT.unpack_from(data, i)
+        i += MAX_WEIGHT.size
+        yield term, doc_freq, start, docs_offset, docs_length, max_weight
+        start += doc_freq
+        docs_offset += docs_length
+
+def weight_range(doc_lengths):
+    '''
+    (min weight, log of max / min weight) quantized weights are spread over. a weight
+    is tf / norm with tf >= 1 and tf <= norm, so it is between 1 / the biggest norm and 1
+    '''
+    max_norm = max(doc_lengths, default=1.0)
+    log_range = math.log(max_norm) if max_norm > 1 else 1.0
+    return 1 / max(max_norm, 1.0), log_range
+
+def quantize(weights, bits, min_weight, log_range):
+    '''
+    weights to 2 ** bits levels spread evenly over their log, so every weight
+    has about the same relative error
+    '''
+    if bits == 32:
+        return array('f', weights)
+    levels = (1 << bits) - 1
+    return array(WEIGHT_TYPES[bits], (min(levels, max(0, round(math.log(weight / min_weight) / log_range * levels)))
+                                      for weight in weights))
+
+def dequantize_table(bits, min_weight, log_range):
+    '''
+    weight of every quantized level, None for float32 weights
+    '''
+    if bits == 32:
+        return None
+    levels = (1 << bits) - 1
+    return array('d', (min_weight * math.exp(level * log_range / levels) for level in range(levels + 1)))
+
+def inverted_index(blocks, docs, output_dir, prune=True, weight_bits=WEIGHT_BITS, positions=False):
+    '''
+    streams the merged postings into the index files, memory used is the docs
+    table plus one token's postings and the write buffers. without prune,
+    tokens that appear in only one document are kept. with positions the
+    postings have positions, which are written to positions.bin
+    '''
+    #positions give the tf back too
+    exact_tf = weight_bits != 32 and not positions
+    #every file is written under a .tmp name and swapped in once all of them are done, so a
+    #server with the old files memory mapped keeps reading them. docs.txt goes in last since
+    #the server reloads when it changes
+    names = ['lexicon.bin', 'postings.bin', 'pruned.bin', 'positions.bin', 'tf.bin']
+    written = [True, True, True, positions, exact_tf]
+    lex_file, post_file, pruned_file, pos_file, tf_file = (os.path.join(output_dir, name + '.tmp') for name in names)
+    docs_file = os.path.join(output_dir, 'docs.txt.tmp')
+
+    #first pass over the merged postings is for calc docs length, indexed by doc id,
+    #and the sizes of the lexicon and postings so both can be written in one go
+    doc_lengths = array('d', bytes(8 * len(docs)))
+    num_terms = 0
+    num_postings = 0
+    with metrics.timer('doc_lengths'):
+        for token, postings in merge_postings(blocks, prune, positions=positions):
+            if positions:
+                postings, _ = split_positions(postings)
+            num_terms += 1
+            num_postings += len(postings) // 2
+            #postings are doc_id, tf pairs
+            for i in range(0, len(postings), 2):
+                doc_lengths[postings[i]] += postings[i + 1] ** 2
+    metrics.count('terms', num_terms)
+    metrics.count('postings', num_postings)
 
     #normalizing docs length
-    for file in doc_lengths:
-        doc_lengths[file] = math.sqrt(doc_lengths[file])
-    num_docs = len(doc_lengths)
-    #stores doc id and term weight for tokens
-    postings = []
-    #stores dictionary and postings results
-    with open(dict_file, 'w') as d_file, open(post_file, 'w') as p_file:
-        posting_pos = 1
-        for token, docs in token_freq.items():
-            idf = math.log(num_docs / doc_freq[token])
-            #writes token, num of docs containing token, and pos
-            d_file.write(f'{token}\n{len(docs)}\n{posting_pos}\n')
-
-            for file, weight in docs.items():
-                tf = weight
-                tf_idf = tf*idf
-                norm_weight = tf_idf / doc_lengths[file]
-                #extract just name of filename from the path 
-                doc_id = os.path.basename(file)
-                #tuple containing doc id and token weight for that token in the document
-                postings.append((doc_id, norm_weight))
-                posting_pos += 1
-        
-        for post in postings:
-            p_file.write(f'{post[0]},{post[1]}\n')
-
-def measure_time(input_dir, output_dir, stop_words_set, num_docs_list):
+    doc_lengths = array('d', (math.sqrt(length) for length in doc_lengths))
+    write_docs(docs_file, docs, doc_lengths)
+    min_weight, log_range = weight_range(doc_lengths)
+    table = dequantize_table(weight_bits, min_weight, log_range)
+
+    #the block table and the blocks of the lexicon, and the weight and doc id columns of
+    #the postings, are two regions of the same file each written through its own handle.
+    #weights have a fixed width so the doc ids start right after them
+    lexicon_start = LEXICON_HEADER.size + LEXICON_BLOCK_ENTRY.size * ((num_terms + LEXICON_BLOCK - 1) // LEXICON_BLOCK)
+    docs_start = POSTINGS_HEADER.size + weight_bits // 8 * num_postings
+    with open(lex_file, 'wb', buffering=RUN_BUFFER) as block_table, \
+            open(post_file, 'wb', buffering=RUN_BUFFER) as weights_column, \
+            open(pruned_file, 'wb', buffering=RUN_BUFFER) as pruned, metrics.timer('postings_write'), \
+            ExitStack() as optional_files:
+        block_table.write(LEXICON_HEADER.pack(LEXICON_MAGIC, num_terms, LEXICON_BLOCK))
+        weights_column.write(POSTINGS_HEADER.pack(POSTINGS_MAGIC, weight_bits, num_postings, min_weight, log_range))
+        if positions:
+            #the offsets of the term blocks and the blocks are two regions like the lexicon
+            offsets_file = optional_files.enter_context(open(pos_file, 'wb', buffering=RUN_BUFFER))
+            offsets_file.write(POSITIONS_HEADER.pack(POSITIONS_MAGIC, POSITIONS_SKIP, num_terms))
+            blocks_file = optional_files.enter_context(open(pos_file, 'r+b', buffering=RUN_BUFFER))
+            blocks_file.seek(POSITIONS_HEADER.size + 8 * (num_terms + 1))
+            positions_offset = 0
+        if exact_tf:
+            tf_column = optional_files.enter_context(open(tf_file, 'wb', buffering=RUN_BUFFER))
+            tf_column.write(TF_MAGIC)
+        with open(lex_file, 'r+b', buffering=RUN_BUFFER) as lexicon_blocks, \
+                open(post_file, 'r+b', buffering=RUN_BUFFER) as docs_column:
+            lexicon_blocks.seek(lexicon_start)
+            docs_column.seek(docs_start)
+            term_number = 0
+            lexicon_offset = 0
+            lexicon_block = bytearray()
+            previous = b''
+            posting_pos = 0
+            docs_offset = 0
+            #second pass writes the weights, tokens come out sorted so phase4 can binary search the lexicon
+            pruned_record = lambda token, postings: write_record(pruned, token, postings)
+            for token, postings in merge_postings(blocks, prune, pruned_record, positions):
+                if positions:
+                    postings, term_positions = split_positions(postings)
+                    block = bytearray()
+                    encode_positions(postings, term_positions, block)
+                    offsets_file.write(struct.pack('<Q', positions_offset))
+                    blocks_file.write(block)
+                    positions_offset += len(block)
+                if exact_tf:
+                    tfs = bytearray()
+                    encode_numbers(postings[1::2], tfs)
+                    tf_column.write(tfs)
+                doc_freq = len(postings) // 2
+                #doc ids are in increasing order as documents are parsed in order
+                posting_docs = bytearray()
+                encode_gaps(postings[0::2], posting_docs)
+                posting_weights = []
+                for doc_id, tf in zip(postings[0::2], postings[1::2]):
+                    norm_weight = tf / doc_lengths[doc_id]
+                    posting_weights.append(norm_weight)
+                posting_weights = quantize(posting_weights, weight_bits, min_weight, log_range)
+                #max of the weights the way phase4 reads them back
+                max_weight = max(posting_weights) if table is None else table[max(posting_weights)]
+
+                term = token.encode('utf-8')
+                if term_number % LEXICON_BLOCK == 0:
+                    lexicon_blocks.write(lexicon_block)
+                    lexicon_offset += len(lexicon_block)
+                    block_table.write(LEXICON_BLOCK_ENTRY.pack(lexicon_offset, posting_pos, docs_offset))
+                    lexicon_block = bytearray()
+                    previous = b''
+                shared = len(os.path.commonprefix((previous, term)))
+                #a single number is its own gap
+                encode_gaps((shared,), lexicon_block)
+                encode_gaps((len(term) - shared,), lexicon_block)
+                lexicon_block += term[shared:]
+                encode_gaps((doc_freq,), lexicon_block)
+                encode_gaps((len(posting_docs),), lexicon_block)
+                lexicon_block += MAX_WEIGHT.pack(max_weight)
+                previous = term
+                term_number += 1
+                posting_pos += doc_freq
+                docs_offset += len(posting_docs)
+                docs_column.write(posting_docs)
+                little_endian(posting_weights).tofile(weights_column)
+            lexicon_blocks.write(lexicon_block)
+            if positions:
+                offsets_file.write(struct.pack('<Q', positions_offset))
+
+    for name, is_written in zip(names, written):
+        path = os.path.join(output_dir, name)
+        if is_written:
+            os.replace(path + '.tmp', path)
+        elif os.path.exists(path):
+            #positions and tf of an older build would not match the new lexicon
+            os.remove(path)
+    os.replace(docs_file, os.path.join(output_dir, 'docs.txt'))
+
+def peak_memory():
+    '''
+    peak resident memory of this process in MB
+    '''
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #bytes on macOS, KB everywhere else
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def clear_segments(output_dir):
+    '''
+    a full build replaces the segments and deletes added by update.py
+    '''
+    for name in (MANIFEST, TOMBSTONES):
+        if os.path.exists(os.path.join(output_dir, name)):
+            os.remove(os.path.join(output_dir, name))
+
+def build_index(files, stop_words_set, output_dir, memory_budget=MEMORY_BUDGET, workers=WORKERS, fast=False, prune=True,
+                weight_bits=WEIGHT_BITS, positions=False):
+    #runs are only needed until the index is written
+    with tempfile.TemporaryDirectory(dir=output_dir) as run_dir:
+        blocks, docs = parse(files, stop_words_set, run_dir, memory_budget, workers, fast, positions)
+        inverted_index(blocks, docs, output_dir, prune, weight_bits, positions)
+    return docs
+
+def measure_time(input_dir, output_dir, stop_words_set, num_docs_list, memory_budget=MEMORY_BUDGET, workers=WORKERS, fast=False,
+                 weight_bits=WEIGHT_BITS, positions=False):
     files = get_filenames(input_dir)
     times_list = [] #for total elapsed time
     total_start_timer = time.time()
@@ -101,19 +726,24 @@ def measure_time(input_dir, output_dir, stop_words_set, num_docs_list):
         start = time.time()
         #subset of files that will contain the first num_docs elements from the files list
         input_dir_subset = files[:num_docs]
-        #returning term frequency and doc frequency
-        tf, df = parse(input_dir_subset, stop_words_set)
-        inverted_index(tf, df, output_dir)
+        build_index(input_dir_subset, stop_words_set, output_dir, memory_budget, workers, fast, weight_bits=weight_bits,
+                    positions=positions)
+        clear_segments(output_dir)
         end = time.time()
         total_time = end - start
-        print(f'Processed {num_docs} files. Time Taken: {total_time} seconds')
+        print(f'Processed {num_docs} files. Time Taken: {total_time} seconds. Peak memory: {peak_memory():.1f} MB')
         times_list.append(total_time)
     total_end_timer = time.time()
     total_time_taken = total_end_timer - total_start_timer
     print(f'Total time taken for the whole program: {total_time_taken} seconds')
     return times_list
 
+#num of builds timed for the plot
+PLOT_STEPS = 10
+
 def plot_time(num_docs_list, time_list):
+    #matplotlib takes longer to import than a small build, only --plot needs it
+    import matplotlib.pyplot as plt
     plt.plot(num_docs_list, time_list, label = 'Total Time')
     plt.xlabel('Num of Documents')
     plt.ylabel('Time (s)')
@@ -122,15 +752,39 @@ def plot_time(num_docs_list, time_list):
 
 if __name__ == "__main__":
 
-    if len(sys.argv) < 2:
-        print("Use python3 index.py input-dir output-dir")
+    #--fast skips building the BeautifulSoup tree, --plot times builds of a growing num of
+    #docs and shows them in a window, phase4 benchmark.py times builds without a window.
+    #--metrics prints the time of every stage at the end, --prometheus prints it for prometheus.
+    #--positions writes positions.bin for the phrase and near queries of phase4
+    fast = '--fast' in sys.argv
+    plot = '--plot' in sys.argv
+    positions = '--positions' in sys.argv
+    prometheus = '--prometheus' in sys.argv
+    metrics.enable('--metrics' in sys.argv or prometheus)
+    args = [arg for arg in sys.argv if arg not in ('--fast', '--plot', '--metrics', '--prometheus', '--positions')]
+    if len(args) < 2:
+        print("Use python3 index.py input-dir output-dir [memory-budget-mb] [workers] [weight-bits] [--fast] [--plot] "
+              "[--positions] [--metrics|--prometheus]")
 
-    input_dir = sys.argv[1]
-    output_dir = sys.argv[2]
+    input_dir = args[1]
+    output_dir = args[2]
+    memory_budget = int(float(args[3]) * 1024 * 1024) if len(args) > 3 else MEMORY_BUDGET
+    workers = int(args[4]) if len(args) > 4 else WORKERS
+    #32 keeps float32 weights, 16 or 8 quantizes them
+    weight_bits = int(args[5]) if len(args) > 5 else WEIGHT_BITS
+    if weight_bits not in WEIGHT_TYPES:
+        print("weight-bits is 32, 16 or 8")
+        sys.exit(2)
 
     #reads in stop words
     with open('stopwords.txt', 'r') as f:
         stop_words_set = {line.strip() for line in f}
-    num_docs_list = [10, 20, 40, 80, 160, 220, 300, 380, 460, 503]
-    elapsed_time = measure_time(input_dir, output_dir, stop_words_set, num_docs_list)
-    plot_time(num_docs_list, elapsed_time)
\ No newline at end of file
+    #the last build has every doc of input-dir, so it is the index left in output-dir
+    num_files = len(get_filenames(input_dir))
+    num_docs_list = [max(1, num_files * (i + 1) // PLOT_STEPS) for i in range(PLOT_STEPS)] if plot else [num_files]
+    elapsed_time = measure_time(input_dir, output_dir, stop_words_set, num_docs_list, memory_budget, workers, fast, weight_bits,
+                                positions)
+    if metrics.enabled:
+        print(metrics.dump(prometheus), end='')
+    if plot:
+        plot_time(num_docs_list, elapsed_time)
\ No newline at end of file
@@ -0,0 +1,381 @@
+import os
+import sys
+import mmap
+import heapq
+import fcntl
+import shutil
+import tempfile
+import subprocess
+from array import array
+from contextlib import contextmanager
+from index import (MANIFEST, TOMBSTONES, POSTINGS_HEADER, POSITIONS_HEADER, WEIGHT_TYPES, MEMORY_BUDGET, WORKERS,
+                   TF_MAGIC, build_index, write_run, read_run, inverted_index, little_endian, decode_gaps,
+                   decode_positions, decode_numbers, dequantize_table, read_lexicon)
+
+#incremental updates of an index built by index.py. new and changed documents are
+#indexed into a delta segment next to the index, deleted and replaced documents are
+#written to tombstones.txt. compact merges every segment back into one
+
+#num of delta segments that starts a compaction in the background
+MAX_DELTAS = 8
+
+@contextmanager
+def locked(index_dir):
+    '''
+    only one process at a time changes segments.txt and tombstones.txt
+    '''
+    with open(os.path.join(index_dir, '.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+@contextmanager
+def compacting(index_dir, hold=True):
+    '''
+    yields whether this process got the compaction lock, which is held without
+    blocking for the whole of a compaction so only one runs at a time. without
+    hold the lock is given back right away, to only check if a compaction runs
+    '''
+    with open(os.path.join(index_dir, '.compact.lock'), 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            if not hold:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def read_docs(segment_dir):
+    docs = []
+    with open(os.path.join(segment_dir, 'docs.txt'), 'r', encoding='UTF-8') as f:
+        for line in f:
+            name, length, norm = line.rstrip('\n').split('\t')
+            docs.append((name, int(length), float(norm)))
+    return docs
+
+def read_manifest(index_dir):
+    '''
+    (segment dir, num of docs) of every segment, an index without segments.txt
+    is the single segment written by index.py
+    '''
+    manifest = os.path.join(index_dir, MANIFEST)
+    if not os.path.exists(manifest):
+        return [('.', len(read_docs(index_dir)))]
+    segments = []
+    with open(manifest, 'r') as f:
+        for line in f:
+            segment, num_docs = line.split('\t')
+            segments.append((segment, int(num_docs)))
+    return segments
+
+def read_tombstones(index_dir):
+    tombstones = set()
+    path = os.path.join(index_dir, TOMBSTONES)
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            for line in f:
+                segment, doc_id = line.split('\t')
+                tombstones.add((segment, int(doc_id)))
+    return tombstones
+
+def replace_file(path, lines):
+    '''
+    writes a new version of path and swaps it in, readers see either version
+    '''
+    with open(path + '.tmp', 'w') as f:
+        for line in lines:
+            f.write(f'{line}\n')
+    os.replace(path + '.tmp', path)
+
+def write_manifest(index_dir, segments):
+    replace_file(os.path.join(index_dir, MANIFEST), (f'{segment}\t{num_docs}' for segment, num_docs in segments))
+
+def write_tombstones(index_dir, tombstones):
+    replace_file(os.path.join(index_dir, TOMBSTONES), (f'{segment}\t{doc_id}' for segment, doc_id in sorted(tombstones)))
+
+def new_segment_dir(index_dir, prefix):
+    #segment dirs are numbered so they sort in the order they were made
+    numbers = [int(name.split('_')[1]) for name in os.listdir(index_dir) if name.split('_')[0] in ('delta', 'base')]
+    segment = f'{prefix}_{max(numbers, default=0) + 1:04d}'
+    os.mkdir(os.path.join(index_dir, segment))
+    return segment
+
+def find_docs(index_dir, segments, tombstones, names):
+    '''
+    (segment dir, doc id) of the docs not deleted yet with one of the names
+    '''
+    found = set()
+    for segment, _ in segments:
+        for doc_id, (name, _, _) in enumerate(read_docs(os.path.join(index_dir, segment))):
+            if name in names and (segment, doc_id) not in tombstones:
+                found.add((segment, doc_id))
+    return found
+
+def add_documents(index_dir, files, stop_words_set, replace=False, workers=WORKERS):
+    '''
+    indexes files into a new delta segment. with replace, the docs already in the
+    index with the same file names are deleted in the same step
+    '''
+    with locked(index_dir):
+        segment = new_segment_dir(index_dir, 'delta')
+        #deltas of an index with positions have positions too
+        positions = has_positions(os.path.join(index_dir, read_manifest(index_dir)[0][0]))
+    #tokens of a single new document are kept, the next compaction prunes them
+    docs = build_index(files, stop_words_set, os.path.join(index_dir, segment), MEMORY_BUDGET, workers, prune=False,
+                       positions=positions)
+    with locked(index_dir):
+        segments = read_manifest(index_dir)
+        tombstones = read_tombstones(index_dir)
+        if replace:
+            names = {os.path.basename(file) for file in files}
+            tombstones |= find_docs(index_dir, segments, tombstones, names)
+            write_tombstones(index_dir, tombstones)
+        segments.append((segment, len(docs)))
+        write_manifest(index_dir, segments)
+    return len(segments) - 1
+
+def delete_documents(index_dir, names):
+    with locked(index_dir):
+        segments = read_manifest(index_dir)
+        tombstones = read_tombstones(index_dir)
+        deleted = find_docs(index_dir, segments, tombstones, set(names))
+        write_tombstones(index_dir, tombstones | deleted)
+        if not os.path.exists(os.path.join(index_dir, MANIFEST)):
+            write_manifest(index_dir, segments)
+    return len(deleted)
+
+def segment_weight_bits(segment_dir):
+    with open(os.path.join(segment_dir, 'postings.bin'), 'rb') as f:
+        return POSTINGS_HEADER.unpack(f.read(POSTINGS_HEADER.size))[1]
+
+def has_positions(segment_dir):
+    return os.path.exists(os.path.join(segment_dir, 'positions.bin'))
+
+def read_segment(segment_dir):
+    '''
+    yields (token, doc ids, weights) of every token of a segment in lexicon order
+    '''
+    with open(os.path.join(segment_dir, 'lexicon.bin'), 'rb') as lex, open(os.path.join(segment_dir, 'postings.bin'), 'rb') as post:
+        lexicon = mmap.mmap(lex.fileno(), 0, access=mmap.ACCESS_READ)
+        postings = mmap.mmap(post.fileno(), 0, access=mmap.ACCESS_READ)
+    _, bits, num_postings, min_weight, log_range = POSTINGS_HEADER.unpack_from(postings, 0)
+    width = bits // 8
+    docs_start = POSTINGS_HEADER.size + width * num_postings
+    table = dequantize_table(bits, min_weight, log_range)
+    for term, doc_freq, start, docs_offset, docs_length, _ in read_lexicon(lexicon):
+        token = term.decode('utf-8')
+        doc_ids = decode_gaps(postings[docs_start + docs_offset:docs_start + docs_offset + docs_length], doc_freq)
+        weights = little_endian(array(WEIGHT_TYPES[bits], postings[POSTINGS_HEADER.size + width * start:
+                                                                  POSTINGS_HEADER.size + width * (start + doc_freq)]))
+        if table is not None:
+            weights = [table[level] for level in weights]
+        yield token, doc_ids, weights
+
+def read_positions(segment_dir):
+    '''
+    yields (token, doc ids, positions of every posting) of every token of a segment
+    in lexicon order
+    '''
+    with open(os.path.join(segment_dir, 'positions.bin'), 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    _, _, num_terms = POSITIONS_HEADER.unpack_from(data, 0)
+    blocks_start = POSITIONS_HEADER.size + 8 * (num_terms + 1)
+    offsets = little_endian(array('Q', data[POSITIONS_HEADER.size:blocks_start]))
+    for i, (token, doc_ids, _) in enumerate(read_segment(segment_dir)):
+        doc_ids = array('i', doc_ids)
+        yield token, doc_ids, decode_positions(data[blocks_start + offsets[i]:blocks_start + offsets[i + 1]], len(doc_ids))
+
+def read_tf(segment_dir):
+    '''
+    yields (token, doc_id, tf pairs) of every token of a segment in lexicon order,
+    the tf from tf.bin
+    '''
+    with open(os.path.join(segment_dir, 'tf.bin'), 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if data[:len(TF_MAGIC)] != TF_MAGIC:
+        raise ValueError(f'{segment_dir}/tf.bin is not a tf file written by index.py')
+    i = len(TF_MAGIC)
+    for token, doc_ids, _ in read_segment(segment_dir):
+        doc_ids = array('i', doc_ids)
+        tfs, i = decode_numbers(data, i, len(doc_ids))
+        postings = array('i', bytes(8 * len(doc_ids)))
+        postings[0::2] = doc_ids
+        postings[1::2] = tfs
+        yield token, postings
+
+def segment_run(segment_dir, new_ids, norms, positions=False):
+    '''
+    postings of a segment as flat doc_id, tf pairs with the new doc ids, deleted docs
+    are left out. weights are tf / norm so the tf is weight * norm, the tokens pruned
+    from the segment are merged back in from pruned.bin. a segment with quantized
+    weights gives the tf of tf.bin, since rounding a quantized weight * norm drifts
+    more at every compaction, and a segment with positions the tf of positions.bin.
+    with positions the tf of a posting is followed by its positions, like the runs of
+    a build with positions
+    '''
+    #postings of a segment with positions are read with them, and dropped when the new base has none
+    positional = has_positions(segment_dir)
+    def indexed():
+        if positional:
+            for token, doc_ids, term_positions in read_positions(segment_dir):
+                postings = array('i')
+                for doc_id, doc_positions in zip(doc_ids, term_positions):
+                    postings.extend((doc_id, len(doc_positions)))
+                    postings.extend(doc_positions)
+                yield token, postings
+            return
+        if os.path.exists(os.path.join(segment_dir, 'tf.bin')):
+            yield from read_tf(segment_dir)
+            return
+        for token, doc_ids, weights in read_segment(segment_dir):
+            yield token, array('i', (x for doc_id, weight in zip(doc_ids, weights)
+                                     for x in (doc_id, round(weight * norms[doc_id]))))
+    streams = [indexed()]
+    if os.path.exists(os.path.join(segment_dir, 'pruned.bin')):
+        streams.append(read_run(os.path.join(segment_dir, 'pruned.bin')))
+    #a token is either in the lexicon or in pruned.bin of a segment, never both
+    for token, old_postings in heapq.merge(*streams, key=lambda x: x[0]):
+        postings = array('i')
+        i = 0
+        while i < len(old_postings):
+            step = 2 + old_postings[i + 1] if positional else 2
+            new_id = new_ids[old_postings[i]]
+            if new_id >= 0:
+                postings.append(new_id)
+                postings.extend(old_postings[i + 1:i + step] if positions else old_postings[i + 1:i + 2])
+            i += step
+        if postings:
+            yield token, postings
+
+def compact(index_dir):
+    '''
+    merges every segment into a new base segment, leaving out deleted docs and
+    pruning tokens that appear in only one document. queries keep using the old
+    segments until segments.txt is swapped, updates made meanwhile are kept.
+    returns False without merging when another process is compacting the index
+    '''
+    with compacting(index_dir) as acquired:
+        if not acquired:
+            return False
+        with locked(index_dir):
+            segments = read_manifest(index_dir)
+            tombstones = read_tombstones(index_dir)
+            base = new_segment_dir(index_dir, 'base')
+        base_dir = os.path.join(index_dir, base)
+        try:
+            new_ids, num_docs = merge_segments(index_dir, segments, tombstones, base_dir)
+            swapped = swap_segments(index_dir, segments, tombstones, base, new_ids, num_docs)
+        except BaseException:
+            #a failed compaction leaves the segments as they were
+            shutil.rmtree(base_dir, ignore_errors=True)
+            raise
+        if not swapped:
+            shutil.rmtree(base_dir)
+            return False
+        #processes with the old segments memory mapped keep reading them until they reload
+        for segment, _ in segments:
+            if segment == '.':
+                for name in ('lexicon.bin', 'postings.bin', 'docs.txt', 'pruned.bin', 'positions.bin', 'tf.bin'):
+                    if os.path.exists(os.path.join(index_dir, name)):
+                        os.remove(os.path.join(index_dir, name))
+            else:
+                shutil.rmtree(os.path.join(index_dir, segment))
+    return True
+
+def merge_segments(index_dir, segments, tombstones, base_dir):
+    '''
+    writes the docs left of segments to base_dir as one segment, returns the new
+    doc id of every doc of every segment, -1 for deleted docs, and the num of docs
+    '''
+    #new doc ids are given to the docs left, in segment order so they stay increasing
+    new_ids = {}
+    docs = []
+    #the new base only has positions if every segment has them
+    positions = all(has_positions(os.path.join(index_dir, segment)) for segment, _ in segments)
+    with tempfile.TemporaryDirectory(dir=base_dir) as run_dir:
+        runs = []
+        for segment, _ in segments:
+            segment_docs = read_docs(os.path.join(index_dir, segment))
+            ids = array('i')
+            for doc_id, (name, length, _) in enumerate(segment_docs):
+                if (segment, doc_id) in tombstones:
+                    ids.append(-1)
+                else:
+                    ids.append(len(docs))
+                    docs.append((name, length))
+            new_ids[segment] = ids
+            run_file = os.path.join(run_dir, f'{segment}.bin')
+            norms = [norm for _, _, norm in segment_docs]
+            write_run(run_file, segment_run(os.path.join(index_dir, segment), ids, norms, positions))
+            runs.append(run_file)
+        #the new base keeps the weight bits of the old one, delta segments always have float32 weights
+        inverted_index(runs, docs, base_dir, weight_bits=segment_weight_bits(os.path.join(index_dir, segments[0][0])),
+                       positions=positions)
+    return new_ids, len(docs)
+
+def swap_segments(index_dir, segments, tombstones, base, new_ids, num_docs):
+    '''
+    puts the new base in place of the segments it merged, False when segments.txt
+    no longer starts with them
+    '''
+    with locked(index_dir):
+        current = read_manifest(index_dir)
+        if current[:len(segments)] != segments:
+            #the index was built again or compacted by a process without the lock
+            return False
+        #deletes made during the compaction are moved to the new doc ids
+        deleted_since = read_tombstones(index_dir) - tombstones
+        moved = set()
+        for segment, doc_id in deleted_since:
+            if segment in new_ids:
+                if new_ids[segment][doc_id] >= 0:
+                    moved.add((base, new_ids[segment][doc_id]))
+            else:
+                moved.add((segment, doc_id))
+        write_manifest(index_dir, [(base, num_docs)] + current[len(segments):])
+        write_tombstones(index_dir, moved)
+    return True
+
+def compact_in_background(index_dir):
+    '''
+    starts compact in its own process, None when a compaction is already running
+    '''
+    with compacting(index_dir, hold=False) as free:
+        if not free:
+            return None
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__), index_dir, 'compact'], start_new_session=True)
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 3 or sys.argv[2] not in ('add', 'replace', 'delete', 'compact'):
+        print("Use python3 update.py index-dir add|replace|delete|compact [files]")
+        sys.exit(2)
+
+    index_dir = sys.argv[1]
+    command = sys.argv[2]
+    files = sys.argv[3:]
+
+    if command == 'compact':
+        compacted = compact(index_dir)
+        print('Compacted the index' if compacted else 'Another process is compacting the index')
+    elif command == 'delete':
+        #docs are deleted by file name, like they are listed in docs.txt
+        deleted = delete_documents(index_dir, [os.path.basename(file) for file in files])
+        print(f'Deleted {deleted} documents')
+    else:
+        #reads in stop words
+        with open('stopwords.txt', 'r') as f:
+            stop_words_set = {line.strip() for line in f}
+        num_deltas = add_documents(index_dir, files, stop_words_set, replace=command == 'replace')
+        print(f'Added {len(files)} documents, the index has {num_deltas} delta segments')
+        if num_deltas >= MAX_DELTAS:
+            if compact_in_background(index_dir):
+                print('Started compacting the index in the background')
+            else:
+                print('The index is being compacted in the background')
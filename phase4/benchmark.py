@@ -0,0 +1,331 @@
+import os
+import re
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import platform
+import tempfile
+import subprocess
+from retrieval import load_inverted_index, maxscore_top_k, sum_document_similarity
+
+#headless benchmark of indexing with phase3 index.py and querying with phase4, the
+#results are written to a json file and compared against a baseline saved by an earlier
+#run so a slower build or query shows up as a regression. every corpus and query set is
+#made from a fixed seed so two runs on the same commit measure the same work
+#
+#  python3 benchmark.py results.json synthetic:10000 /data/html:5000 --baseline=base.json
+#
+#a corpus is synthetic:num-docs for docs of random words with zipf frequencies, or an
+#input dir with the num of docs to take from it, its files are used again under new
+#names when it has fewer docs. --startup also times the import of every entry point
+#against its budget, without corpora it only does that. --deletes also deletes docs from
+#the index of every corpus with update.py and checks the scores of one token queries
+#against an index built again from the docs left, before it is compacted
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+PHASE3_DIR = os.path.join(ROOT_DIR, 'phase3')
+SEED = 0
+DEFAULT_CORPORA = ['synthetic:2000']
+#synthetic docs
+VOCABULARY = 50000
+MIN_DOC_TOKENS = 50
+MAX_DOC_TOKENS = 2000
+#queries made from the lexicon when no query file is given, 1 to MAX_QUERY_TOKENS tokens
+NUM_QUERIES = 500
+MAX_QUERY_TOKENS = 3
+K = 10
+#every DELETE_EVERY th doc is deleted by --deletes
+DELETE_EVERY = 7
+#index.py arguments
+MEMORY_BUDGET_MB = 256
+WORKERS = os.cpu_count() or 1
+#a metric this much worse than the baseline is a regression
+TOLERANCE = 0.15
+#ms an entry point may take to import on top of starting python, heavy modules like
+#matplotlib, BeautifulSoup and sklearn are only imported by the paths that use them
+STARTUP_BUDGET_MS = {'phase1/tokenizer_p1.py': 150, 'phase1/parity_check.py': 150, 'phase2/tokenizer_p2.py': 150,
+                     'phase3/index.py': 150, 'phase3/update.py': 150, 'phase4/retrieval.py': 50,
+                     'phase4/postings_benchmark.py': 50, 'phase4/server.py': 150, 'phase4/benchmark.py': 100,
+                     'phase5/clustering.py': 600, 'phase5/similar.py': 600}
+#imports timed per entry point, the fastest one is kept
+STARTUP_REPEATS = 5
+#metrics compared with the baseline, True when a bigger value is better
+METRICS = {'docs_per_second': True, 'mb_per_second': True, 'peak_rss_mb': False, 'index_bytes': False,
+           'query_p50_ms': False, 'query_p90_ms': False, 'query_p99_ms': False}
+
+def synthetic_corpus(corpus_dir, num_docs, seed=SEED):
+    '''
+    html docs of random words, the ith most common word is used about 1 / i as often
+    as the most common one like the words of real text
+    '''
+    rng = random.Random(seed)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    words = list(dict.fromkeys(''.join(rng.choices(letters, k=rng.randint(3, 10))) for _ in range(VOCABULARY)))
+    cum_weights = []
+    total = 0.0
+    for rank in range(len(words)):
+        total += 1 / (rank + 1)
+        cum_weights.append(total)
+    for doc in range(num_docs):
+        tokens = rng.choices(words, cum_weights=cum_weights, k=rng.randint(MIN_DOC_TOKENS, MAX_DOC_TOKENS))
+        paragraphs = (' '.join(tokens[i:i + 50]) for i in range(0, len(tokens), 50))
+        with open(os.path.join(corpus_dir, f'{doc:07d}.html'), 'w') as f:
+            f.write(f'<html><head><title>doc {doc}</title></head><body>')
+            f.write(''.join(f'<p>{paragraph}</p>' for paragraph in paragraphs))
+            f.write('</body></html>')
+
+def real_corpus(corpus_dir, input_dir, num_docs, seed=SEED):
+    '''
+    num_docs files of input_dir picked at random, linked in corpus_dir
+    '''
+    files = sorted(os.path.join(input_dir, name) for name in os.listdir(input_dir)
+                   if os.path.isfile(os.path.join(input_dir, name)))
+    random.Random(seed).shuffle(files)
+    for doc in range(num_docs):
+        file = files[doc % len(files)]
+        os.symlink(os.path.abspath(file), os.path.join(corpus_dir, f'{doc:07d}_{os.path.basename(file)}'))
+
+def make_corpus(corpus, corpus_dir):
+    '''
+    writes the docs of corpus to corpus_dir, returns its num of docs
+    '''
+    source, _, num_docs = corpus.rpartition(':')
+    if not source:
+        #an input dir without a num of docs, every file once
+        source, num_docs = corpus, None
+    if source == 'synthetic':
+        synthetic_corpus(corpus_dir, int(num_docs))
+    else:
+        num_files = sum(1 for name in os.listdir(source) if os.path.isfile(os.path.join(source, name)))
+        real_corpus(corpus_dir, source, int(num_docs) if num_docs else num_files)
+    return len(os.listdir(corpus_dir))
+
+def dir_bytes(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path)
+               if os.path.isfile(os.path.join(path, name)))
+
+def build(corpus_dir, index_dir, workers=WORKERS):
+    '''
+    runs index.py in its own process, returns (build seconds, peak rss in MB).
+    the seconds are the ones index.py prints so they leave out starting python,
+    the rss is of the biggest process of the build
+    '''
+    process = subprocess.Popen([sys.executable, 'index.py', os.path.abspath(corpus_dir), os.path.abspath(index_dir),
+                                str(MEMORY_BUDGET_MB), str(workers), '--fast'],
+                               cwd=PHASE3_DIR, stdout=subprocess.PIPE, text=True)
+    output = process.stdout.read()
+    process.stdout.close()
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError(f'index.py failed with exit code {process.returncode}')
+    seconds = float(re.search(r'Time Taken: ([0-9.e-]+) seconds', output).group(1))
+    #bytes on macOS, KB everywhere else
+    peak = usage.ru_maxrss / (1024 * 1024) if sys.platform == 'darwin' else usage.ru_maxrss / 1024
+    return seconds, peak
+
+def make_queries(index, num_queries=NUM_QUERIES, seed=SEED):
+    '''
+    queries of tokens picked at random from the lexicon of the first segment,
+    tokens found in a single doc are left out like most real queries would
+    '''
+    lexicon = index.segments[0][0]
+    tokens = [term.decode('utf-8') for term, entry in lexicon.items() if entry[0] > 1]
+    rng = random.Random(seed)
+    return [rng.sample(tokens, rng.randint(1, min(MAX_QUERY_TOKENS, len(tokens)))) for _ in range(num_queries)]
+
+def percentile(values, p):
+    #nearest rank
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))]
+
+def query_latencies(index_dir, queries):
+    '''
+    ms of every query. nothing is cached so every query decodes its postings,
+    the order of the queries does not change the times
+    '''
+    index = load_inverted_index(index_dir, 0, 0)
+    queries = queries or make_queries(index)
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        maxscore_top_k(index, query, K)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+def run(corpus, work_dir, queries=None, workers=WORKERS):
+    corpus_dir = os.path.join(work_dir, 'corpus')
+    index_dir = os.path.join(work_dir, 'index')
+    os.mkdir(corpus_dir)
+    os.mkdir(index_dir)
+    try:
+        num_docs = make_corpus(corpus, corpus_dir)
+        input_mb = sum(os.path.getsize(os.path.join(corpus_dir, name)) for name in os.listdir(corpus_dir)) / 1e6
+        seconds, peak_rss = build(corpus_dir, index_dir, workers)
+        latencies = query_latencies(index_dir, queries)
+        return {'corpus': corpus, 'num_docs': num_docs, 'input_mb': input_mb, 'build_seconds': seconds,
+                'docs_per_second': num_docs / seconds, 'mb_per_second': input_mb / seconds, 'peak_rss_mb': peak_rss,
+                'index_bytes': dir_bytes(index_dir), 'num_queries': len(latencies),
+                'query_mean_ms': sum(latencies) / len(latencies), 'query_p50_ms': percentile(latencies, 50),
+                'query_p90_ms': percentile(latencies, 90), 'query_p99_ms': percentile(latencies, 99)}
+    finally:
+        shutil.rmtree(corpus_dir)
+        shutil.rmtree(index_dir)
+
+def doc_scores(index, token):
+    #name: (norm, score) of every doc left with the token
+    scores, found = sum_document_similarity(index, [token])
+    return {index.docs[doc][0]: (index.docs[doc][2], scores[doc]) for doc in found}
+
+def check_deletes(corpus, work_dir, workers=WORKERS):
+    '''
+    deletes every DELETE_EVERY th doc of the corpus from its index, then builds an
+    index of the docs left. every token of the new index has to have the same idf and
+    be in the same docs in both, with the same scores in the docs whose norm did not
+    change, returns the tokens that do not. a doc with a token that is in a single doc
+    after the deletes has another norm in the new index since that token is pruned
+    '''
+    corpus_dir = os.path.join(work_dir, 'corpus')
+    live_dir = os.path.join(work_dir, 'live')
+    index_dir = os.path.join(work_dir, 'index')
+    rebuilt_dir = os.path.join(work_dir, 'rebuilt')
+    for path in (corpus_dir, live_dir, index_dir, rebuilt_dir):
+        os.mkdir(path)
+    make_corpus(corpus, corpus_dir)
+    build(corpus_dir, index_dir, workers)
+    names = sorted(os.listdir(corpus_dir))
+    deleted = names[::DELETE_EVERY]
+    subprocess.run([sys.executable, 'update.py', os.path.abspath(index_dir), 'delete'] + deleted,
+                   cwd=PHASE3_DIR, check=True, stdout=subprocess.DEVNULL)
+    for name in set(names) - set(deleted):
+        shutil.copy(os.path.join(corpus_dir, name), live_dir)
+    build(live_dir, rebuilt_dir, workers)
+    index = load_inverted_index(index_dir, 0, 0)
+    rebuilt = load_inverted_index(rebuilt_dir, 0, 0)
+    mismatches = []
+    for token in [term.decode('utf-8') for term, _ in rebuilt.segments[0][0].items()]:
+        scores, rebuilt_scores = doc_scores(index, token), doc_scores(rebuilt, token)
+        if not math.isclose(index.idf(token), rebuilt.idf(token)) or scores.keys() != rebuilt_scores.keys() or \
+                any(norm == rebuilt_scores[name][0] and not math.isclose(score, rebuilt_scores[name][1])
+                    for name, (norm, score) in scores.items()):
+            mismatches.append(token)
+    return mismatches
+
+def run_python(code, cwd):
+    #seconds of running code in a new python
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', code], cwd=cwd, check=True)
+    return time.perf_counter() - start
+
+def startup_times():
+    '''
+    ms of importing every entry point in a new python from its phase dir, the
+    ms of starting python alone are taken out
+    '''
+    python = min(run_python('pass', ROOT_DIR) for _ in range(STARTUP_REPEATS))
+    times = {}
+    for script in STARTUP_BUDGET_MS:
+        phase_dir, name = os.path.split(script)
+        module = os.path.splitext(name)[0]
+        seconds = min(run_python(f'import {module}', os.path.join(ROOT_DIR, phase_dir)) for _ in range(STARTUP_REPEATS))
+        times[script] = max(0.0, seconds - python) * 1000
+    return times
+
+def check_startup(times):
+    '''
+    prints the startup of every entry point next to its budget, returns the ones over it
+    '''
+    over = []
+    print(f'{"entry point":<32}{"import ms":>10}{"budget":>8}')
+    for script, ms in times.items():
+        flag = ' over budget' if ms > STARTUP_BUDGET_MS[script] else ''
+        print(f'{script:<32}{ms:>10.1f}{STARTUP_BUDGET_MS[script]:>8}{flag}')
+        if flag:
+            over.append(script)
+    return over
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=PHASE3_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+            'workers': WORKERS, 'commit': commit, 'seed': SEED, 'k': K, 'memory_budget_mb': MEMORY_BUDGET_MB}
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    '''
+    prints every metric next to the baseline, returns the regressions as
+    (corpus, metric, baseline value, value)
+    '''
+    baseline_runs = {run['corpus']: run for run in baseline['runs']}
+    regressions = []
+    print(f'{"corpus":<28}{"metric":<18}{"baseline":>12}{"now":>12}{"change":>9}')
+    for run in results['runs']:
+        old = baseline_runs.get(run['corpus'])
+        if old is None:
+            continue
+        for metric, bigger_is_better in METRICS.items():
+            change = run[metric] / old[metric] - 1 if old[metric] else 0.0
+            worse = -change if bigger_is_better else change
+            flag = ' regression' if worse > tolerance else ''
+            print(f'{run["corpus"]:<28}{metric:<18}{old[metric]:>12.2f}{run[metric]:>12.2f}{change:>+9.1%}{flag}')
+            if flag:
+                regressions.append((run['corpus'], metric, old[metric], run[metric]))
+    return regressions
+
+def read_queries(query_file):
+    #one query per line, like the command line of retrieval.py
+    with open(query_file, 'r') as f:
+        return [[word.lower() for word in line.split()] for line in f if line.strip()]
+
+if __name__ == "__main__":
+
+    options = dict(arg[2:].split('=', 1) for arg in sys.argv if arg.startswith('--') and '=' in arg)
+    args = [arg for arg in sys.argv if not arg.startswith('--')]
+    if len(args) < 2:
+        print("Use python3 benchmark.py results.json [synthetic:num-docs|input-dir[:num-docs] ...] "
+              "[--baseline=baseline.json] [--queries=queries.txt] [--workers=n] [--startup] [--deletes]")
+        sys.exit(2)
+
+    startup = '--startup' in sys.argv
+    deletes = '--deletes' in sys.argv
+    results_file = args[1]
+    corpora = args[2:] or ([] if startup else DEFAULT_CORPORA)
+    queries = read_queries(options['queries']) if 'queries' in options else None
+    workers = int(options.get('workers', WORKERS))
+
+    results = {'environment': environment(), 'runs': []}
+    results['environment']['workers'] = workers
+    over_budget = []
+    if startup:
+        results['startup_ms'] = startup_times()
+        over_budget = check_startup(results['startup_ms'])
+    for corpus in corpora:
+        with tempfile.TemporaryDirectory() as work_dir:
+            result = run(corpus, work_dir, queries, workers)
+        results['runs'].append(result)
+        print(f'{corpus}: {result["num_docs"]} docs, {result["docs_per_second"]:.0f} docs/s, '
+              f'{result["mb_per_second"]:.2f} MB/s, peak rss {result["peak_rss_mb"]:.1f} MB, '
+              f'index {result["index_bytes"] / 1e6:.2f} MB, query p50 {result["query_p50_ms"]:.2f} ms '
+              f'p99 {result["query_p99_ms"]:.2f} ms')
+    mismatches = []
+    if deletes:
+        for corpus in corpora:
+            with tempfile.TemporaryDirectory() as work_dir:
+                corpus_mismatches = check_deletes(corpus, work_dir, workers)
+            print(f'{corpus}: {len(corpus_mismatches)} tokens score differently after deletes than rebuilt '
+                  f'{" ".join(corpus_mismatches[:10])}')
+            mismatches += corpus_mismatches
+    with open(results_file, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    regressions = []
+    if 'baseline' in options:
+        with open(options['baseline'], 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline)
+        print(f'{len(regressions)} regressions against {options["baseline"]}')
+    sys.exit(1 if regressions or over_budget or mismatches else 0)
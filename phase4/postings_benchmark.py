@@ -0,0 +1,90 @@
+import os
+import sys
+import time
+from array import array
+from retrieval import POSTINGS_HEADER, Lexicon, Postings, load_docs
+
+#bytes per posting and decode throughput of the postings of indexes written by phase3,
+#next to the postings.txt text format phase3 used to write and uncompressed int32 doc ids
+#with float32 weights. run it on indexes built with different weight bits to compare them
+
+#times every decode is run, the fastest one is kept
+REPEATS = 5
+
+def best_time(decode):
+    best = float('inf')
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        decode()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def read_all(entries, postings):
+    '''
+    decodes the postings of every term, term by term like a query does
+    '''
+    for entry in entries:
+        for _ in postings.read(entry):
+            pass
+
+def text_format(entries, postings, docs):
+    #one line per posting with the file name and weight, like postings.txt
+    lines = []
+    for entry in entries:
+        for doc, weight in postings.read(entry):
+            lines.append(f'{docs[doc][0]},{weight}\n')
+    return ''.join(lines).encode('utf-8')
+
+def parse_text(text):
+    #the way phase4 read postings.txt
+    for line in text.decode('utf-8').splitlines():
+        doc, score = line.split(',')
+        float(score)
+
+def raw_format(entries, postings):
+    doc_ids = array('i')
+    weights = array('f')
+    for entry in entries:
+        for doc, weight in postings.read(entry):
+            doc_ids.append(doc)
+            weights.append(weight)
+    return doc_ids.tobytes() + weights.tobytes()
+
+def parse_raw(entries, raw):
+    #the format phase4 read before the doc ids were compressed
+    view = memoryview(raw)
+    half = len(raw) // 2
+    doc_ids = view[:half].cast('i')
+    weights = view[half:].cast('f')
+    for number_postings, start, _, _, _ in entries:
+        for _ in zip(doc_ids[start:start + number_postings], weights[start:start + number_postings]):
+            pass
+
+def report(name, num_bytes, num_postings, seconds):
+    print(f'{name:<24}{num_bytes / num_postings:>10.2f}{num_postings / seconds / 1e6:>14.2f}')
+
+def benchmark(index_dirs):
+    print(f'{"format":<24}{"bytes/post":>10}{"M postings/s":>14}')
+    for n, index_dir in enumerate(index_dirs):
+        lexicon = Lexicon(os.path.join(index_dir, 'lexicon.bin'))
+        postings = Postings(os.path.join(index_dir, 'postings.bin'))
+        num_postings = len(postings)
+        entries = [entry for _, entry in lexicon.items()]
+        if n == 0:
+            #the other formats are made from the postings of the first index
+            docs = load_docs(os.path.join(index_dir, 'docs.txt'))
+            text = text_format(entries, postings, docs)
+            report('postings.txt', len(text), num_postings, best_time(lambda: parse_text(text)))
+            raw = raw_format(entries, postings)
+            report('int32 + float32', len(raw), num_postings, best_time(lambda: parse_raw(entries, raw)))
+        bits = POSTINGS_HEADER.unpack_from(postings.mapped, 0)[1]
+        num_bytes = os.path.getsize(os.path.join(index_dir, 'postings.bin')) - POSTINGS_HEADER.size
+        report(f'varbyte + {bits} bit', num_bytes, num_postings, best_time(lambda: read_all(entries, postings)))
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 2:
+        print("Use python3 postings_benchmark.py index-dir [index-dir ...]")
+        sys.exit(2)
+
+    benchmark(sys.argv[1:])
@@ -3,82 +3,1064 @@ import sys
 import time
 import re
 import math
-from collections import defaultdict
+import mmap
+import heapq
+import struct
+import threading
+from array import array
+from bisect import bisect_left
+from fnmatch import fnmatchcase
+from itertools import accumulate, islice
+from collections import defaultdict, OrderedDict
+import metrics
 
-def load_inverted_index():
+#binary index layout written by phase3 index.py
+LEXICON_MAGIC = b'LEX4'
+POSTINGS_MAGIC = b'PST2'
+POSITIONS_MAGIC = b'POS1'
+LEXICON_HEADER = struct.Struct('<4sII') #magic, num of terms, terms per block
+#byte offset of a block after the block table, start pos in postings and doc ids offset of its first term
+LEXICON_BLOCK_ENTRY = struct.Struct('<QQQ')
+MAX_WEIGHT = struct.Struct('<d')
+#magic, bits of a weight, num of postings, min weight, log of max weight / min weight
+POSTINGS_HEADER = struct.Struct('<4sB3xQdd')
+WEIGHT_TYPES = {32: 'f', 16: 'H', 8: 'B'}
+POSITIONS_HEADER = struct.Struct('<4sII') #magic, postings per skip, num of terms
+#segments and deleted docs of an index updated by phase3 update.py
+MANIFEST = 'segments.txt'
+TOMBSTONES = 'tombstones.txt'
+#default bytes of decoded postings and of query results kept in memory
+POSTINGS_CACHE_BYTES = 64 * 1024 * 1024
+RESULTS_CACHE_BYTES = 8 * 1024 * 1024
+#bytes of looked up terms kept by the lexicon of every segment, and about the bytes of one
+LEXICON_CACHE_BYTES = 4 * 1024 * 1024
+LEXICON_ENTRY_BYTES = 200
+#after the last doc id of a token
+END = 2 ** 31 - 1
+#most terms a wildcard token of a query is replaced by, the first ones in term order
+MAX_EXPANSIONS = 1024
+
+def map_file(path, magic):
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if mapped[:len(magic)] != magic:
+        raise ValueError(f'{path} is not an index file written by phase3')
+    return mapped
+
+class Lexicon:
     '''
-    dictionary.txt and postings.txt are loaded in the memory as lists
+    front coded term table of lexicon.bin. the first terms of the blocks are binary
+    searched in the memory mapped file and the block a term is in is decoded up to
+    it. the terms looked up most recently are kept in an LRU cache so a long running
+    process searches for a common term once. terms come in sorted order, so the terms with a prefix or between
+    two terms are next to each other
     '''
-    with open('dictionary.txt', 'r', encoding='UTF-8') as dict_file, open('postings.txt', 'r') as post_file:
-        dictionary = dict_file.read().splitlines()
-        postings = post_file.read().splitlines()
-    return dictionary, postings
+    def __init__(self, lex_file, cache_bytes=LEXICON_CACHE_BYTES):
+        self.mapped = map_file(lex_file, LEXICON_MAGIC)
+        _, self.num_terms, self.block_size = LEXICON_HEADER.unpack_from(self.mapped, 0)
+        self.num_blocks = (self.num_terms + self.block_size - 1) // self.block_size
+        blocks_start = LEXICON_HEADER.size + LEXICON_BLOCK_ENTRY.size * self.num_blocks
+        view = memoryview(self.mapped)
+        #byte offset, start pos in postings and doc ids offset of every block
+        self.block_table = view[LEXICON_HEADER.size:blocks_start].cast('Q')
+        self.blocks = view[blocks_start:]
+        #(num of the term, entry) of find for terms in the lexicon and not
+        self.cache = LRUCache(cache_bytes, lambda found: LEXICON_ENTRY_BYTES)
 
-def printing_top_10(found_query, query):
-    #sorting to display top 10 terms
-    sorted_found = sorted(found_query.items(), key=lambda x: x[1], reverse=True)
-    #query = ' '.join(query)
-    
-    print(f'{query} was found in {len(found_query)} documents')
-    #print(sorted_found)
-    count = 0 
-    for doc, score in sorted_found:
-        #if score > 0:
-            print(f'{doc}, {score}')
-            count += 1
-            if count == 10:
-                break
+    def first_term(self, block):
+        #the first term of a block shares nothing with the term before it
+        i = self.block_table[3 * block] + 1
+        length, i = read_number(self.blocks, i)
+        return self.blocks[i:i + length].tobytes()
+
+    def block(self, block):
+        '''
+        yields (term, entry) of every term of a block, entries are num of postings, start
+        pos in postings, doc ids offset, doc ids bytes and max weight
+        '''
+        data = self.blocks
+        i, start, docs_offset = self.block_table[3 * block:3 * block + 3]
+        term = b''
+        for _ in range(min(self.block_size, self.num_terms - block * self.block_size)):
+            #most numbers are a single byte
+            shared, length = data[i], data[i + 1]
+            if shared | length < 128:
+                i += 2
+            else:
+                shared, i = read_number(data, i)
+                length, i = read_number(data, i)
+            term = term[:shared] + data[i:i + length].tobytes()
+            i += length
+            doc_freq, docs_length = data[i], data[i + 1]
+            if doc_freq | docs_length < 128:
+                i += 2
+            else:
+                doc_freq, i = read_number(data, i)
+                docs_length, i = read_number(data, i)
+            max_weight, = MAX_WEIGHT.unpack_from(data, i)
+            i += MAX_WEIGHT.size
+            yield term, (doc_freq, start, docs_offset, docs_length, max_weight)
+            start += doc_freq
+            docs_offset += docs_length
+
+    def seek(self, term):
+        '''
+        (num, term, entry) of the first term that is not less than term, (num_terms, None,
+        None) if there is none
+        '''
+        low, high = 0, self.num_blocks
+        while low < high:
+            middle = (low + high) // 2
+            if self.first_term(middle) <= term:
+                low = middle + 1
+            else:
+                high = middle
+        #low is the first block that starts after term, term is in the block before it
+        block = max(low - 1, 0)
+        for i, (block_term, entry) in enumerate(self.block(block) if self.num_blocks else ()):
+            if block_term >= term:
+                return block * self.block_size + i, block_term, entry
+        return low * self.block_size if low < self.num_blocks else self.num_terms, None, None
+
+    def items(self, start=0):
+        '''
+        yields (term, entry) of the terms from the num start on
+        '''
+        for block in range(start // self.block_size, self.num_blocks):
+            yield from islice(self.block(block), max(0, start - block * self.block_size), None)
+
+    def entry(self, i):
+        return next(self.items(i))[1]
+
+    def term(self, i):
+        return next(self.items(i))[0]
+
+    def lower_bound(self, term):
+        #num of the first term that is not less than term, num_terms if there is none
+        return self.seek(term)[0]
+
+    def find(self, token):
+        '''
+        (num of the term in the lexicon, entry), (-1, None) if it is not in it
+        '''
+        term = token.encode('utf-8')
+        i, found_term, entry = self.seek(term)
+        return (i, entry) if found_term == term else (-1, None)
+
+    def search(self, token):
+        #num of postings, start pos in postings, doc ids offset, doc ids bytes, max weight
+        return self.find(token)[1]
+
+    def cached_find(self, token):
+        found = self.cache.get(token)
+        if found is None:
+            found = self.find(token)
+            self.cache.put(token, found)
+        return found
+
+    def number(self, token):
+        #positions.bin has the blocks of the terms in lexicon order
+        return self.cached_find(token)[0]
+
+    def range(self, low, high=None):
+        '''
+        terms from low up to, not with, high as strings
+        '''
+        high = None if high is None else high.encode('utf-8')
+        for term, _ in self.items(self.lower_bound(low.encode('utf-8'))):
+            if high is not None and term >= high:
+                return
+            yield term.decode('utf-8')
+
+    def prefix(self, prefix):
+        #terms that start with prefix
+        start = prefix.encode('utf-8')
+        for term, _ in self.items(self.lower_bound(start)):
+            if not term.startswith(start):
+                return
+            yield term.decode('utf-8')
+
+    def wildcard(self, pattern):
+        '''
+        terms matching a pattern with * for any letters and ? for one letter. only the
+        terms with the letters before the first wildcard are checked, a pattern starting
+        with a wildcard checks every term
+        '''
+        prefix = re.split(r'[*?]', pattern, 1)[0]
+        return (term for term in self.prefix(prefix) if fnmatchcase(term, pattern))
+
+    def get(self, token):
+        return self.cached_find(token)[1]
+
+    def __contains__(self, token):
+        return self.get(token) is not None
+
+    def __getitem__(self, token):
+        entry = self.get(token)
+        if entry is None:
+            raise KeyError(token)
+        return entry
+
+    def __len__(self):
+        return self.num_terms
+
+def decode_gaps(data, num_postings):
+    '''
+    doc ids from their variable byte encoded gaps, 7 bits a byte with the high
+    bit set on every byte of a gap but the last
+    '''
+    if len(data) == num_postings:
+        #every gap fits in one byte, summing them up is done in C
+        return accumulate(data)
+    doc_ids = array('i')
+    doc_id, gap, shift = 0, 0, 0
+    for byte in data:
+        if byte & 128:
+            gap |= (byte & 127) << shift
+            shift += 7
+        else:
+            doc_id += gap | byte << shift
+            doc_ids.append(doc_id)
+            gap, shift = 0, 0
+    return doc_ids
+
+class Postings:
+    '''
+    weight and doc id columns of postings.bin, only the pages of the postings
+    a query reads are loaded by the os. quantized weights are looked up in a
+    table with the weight of every level
+    '''
+    def __init__(self, post_file):
+        self.mapped = map_file(post_file, POSTINGS_MAGIC)
+        _, bits, self.num_postings, min_weight, log_range = POSTINGS_HEADER.unpack_from(self.mapped, 0)
+        weights_start = POSTINGS_HEADER.size
+        docs_start = weights_start + bits // 8 * self.num_postings
+        view = memoryview(self.mapped)
+        self.weights = view[weights_start:docs_start].cast(WEIGHT_TYPES[bits])
+        self.doc_ids = view[docs_start:]
+        self.table = None
+        if bits != 32:
+            levels = (1 << bits) - 1
+            self.table = array('d', (min_weight * math.exp(level * log_range / levels) for level in range(levels + 1)))
+
+    def read(self, entry):
+        '''
+        returns (doc id, weight) of the postings of a lexicon entry
+        '''
+        number_postings, start, docs_offset, docs_length, _ = entry
+        doc_ids = decode_gaps(self.doc_ids[docs_offset:docs_offset + docs_length], number_postings)
+        weights = self.weights[start:start + number_postings]
+        if self.table is not None:
+            weights = map(self.table.__getitem__, weights)
+        return zip(doc_ids, weights)
+
+    def arrays(self, entry, first_doc=0):
+        '''
+        doc ids, moved up by first_doc, and weights of the postings of a lexicon
+        entry as arrays, decoded in one go so they can be binary searched
+        '''
+        number_postings, start, docs_offset, docs_length, _ = entry
+        doc_ids = decode_gaps(self.doc_ids[docs_offset:docs_offset + docs_length], number_postings)
+        if first_doc:
+            doc_ids = map(first_doc.__add__, doc_ids)
+        weights = self.weights[start:start + number_postings]
+        if self.table is not None:
+            weights = map(self.table.__getitem__, weights)
+        return array('i', doc_ids), array('d', weights)
+
+    def __len__(self):
+        return self.num_postings
+
+def read_number(data, i):
+    '''
+    (variable byte number at i, index after it)
+    '''
+    number, shift = 0, 0
+    while data[i] & 128:
+        number |= (data[i] & 127) << shift
+        shift += 7
+        i += 1
+    return number | data[i] << shift, i + 1
+
+class Positions:
+    '''
+    positions.bin of a segment built with positions. the block of a term starts with
+    the offset of every skip-th posting, a posting is found by jumping to the one
+    before it in the table and skipping the postings in between by their bytes,
+    only the positions of that posting are decoded
+    '''
+    def __init__(self, pos_file):
+        self.mapped = map_file(pos_file, POSITIONS_MAGIC)
+        _, self.skip, num_terms = POSITIONS_HEADER.unpack_from(self.mapped, 0)
+        blocks_start = POSITIONS_HEADER.size + 8 * (num_terms + 1)
+        view = memoryview(self.mapped)
+        self.offsets = view[POSITIONS_HEADER.size:blocks_start].cast('Q')
+        self.blocks = view[blocks_start:]
+
+    def read(self, term, num_postings, posting):
+        '''
+        positions of a posting of the term, term is its num in the lexicon
+        '''
+        start = self.offsets[term]
+        skips_length = 4 * ((num_postings + self.skip - 1) // self.skip)
+        skips = self.blocks[start:start + skips_length].cast('I')
+        i = start + skips_length + skips[posting // self.skip]
+        for _ in range(posting % self.skip):
+            _, i = read_number(self.blocks, i)
+            length, i = read_number(self.blocks, i)
+            i += length
+        tf, i = read_number(self.blocks, i)
+        length, i = read_number(self.blocks, i)
+        return array('i', decode_gaps(self.blocks[i:i + length], tf))
+
+def is_wildcard(token):
+    return '*' in token or '?' in token
+
+def load_docs(docs_file):
+    '''
+    docs table, the line number is the doc id and every line has
+    the file name, num of tokens and norm of the doc
+    '''
+    docs = []
+    with open(docs_file, 'r', encoding='UTF-8') as f:
+        for line in f:
+            name, length, norm = line.rstrip('\n').split('\t')
+            docs.append((name, int(length), float(norm)))
+    return docs
+
+def load_segments(index_dir):
+    '''
+    segment dirs from segments.txt written by phase3 update.py, an index
+    without it is a single segment
+    '''
+    manifest = os.path.join(index_dir, MANIFEST)
+    if not os.path.exists(manifest):
+        return ['.']
+    with open(manifest, 'r') as f:
+        return [line.split('\t')[0] for line in f]
+
+def load_tombstones(index_dir):
+    tombstones = set()
+    path = os.path.join(index_dir, TOMBSTONES)
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            for line in f:
+                segment, doc_id = line.split('\t')
+                tombstones.add((segment, int(doc_id)))
+    return tombstones
+
+class LRUCache:
+    '''
+    dict that keeps the most recently used values up to max_bytes, size
+    gives the bytes of a value. safe to use from the threads of the server
+    '''
+    def __init__(self, max_bytes, size):
+        self.max_bytes = max_bytes
+        self.size = size
+        self.values = OrderedDict()
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.values:
+                self.hits += 1
+                self.values.move_to_end(key)
+                return self.values[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        value_size = self.size(value)
+        #a value bigger than the whole cache is not kept
+        if value_size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.values:
+                self.used -= self.size(self.values.pop(key))
+            self.values[key] = value
+            self.used += value_size
+            while self.used > self.max_bytes:
+                _, evicted = self.values.popitem(last=False)
+                self.used -= self.size(evicted)
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+            self.used = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.values), 'bytes': self.used}
+
+def arrays_size(arrays):
+    return sum(64 + values.itemsize * len(values) for values in arrays)
+
+def results_size(top):
+    #a list of (doc id, score) tuples
+    return 64 + 100 * len(top)
+
+class Index:
+    '''
+    the segments of an index with the docs table of all of them. doc ids of
+    a segment start after the docs of the segments before it, deleted has a
+    byte per doc id set for docs in tombstones.txt. decoded postings and query
+    results are cached, a reloaded index starts with empty caches. segments built
+    with positions have their positions.bin, the others None
+    '''
+    def __init__(self, segments, docs, deleted, postings_cache_bytes=POSTINGS_CACHE_BYTES,
+                 results_cache_bytes=RESULTS_CACHE_BYTES, segment_positions=None):
+        self.segments = segments #(lexicon, postings, first doc id) of every segment
+        self.docs = docs
+        self.deleted = deleted
+        self.segment_positions = segment_positions or [None] * len(segments)
+        self.postings_cache = LRUCache(postings_cache_bytes, arrays_size)
+        self.results_cache = LRUCache(results_cache_bytes, results_size)
+        #docs without any token and deleted docs do not count towards the idf
+        self.num_docs = sum(1 for doc, (_, _, norm) in enumerate(docs) if norm > 0 and not deleted[doc])
+        self.any_deleted = any(deleted)
+
+    def entries(self, token):
+        '''
+        (segment, num of the term in its lexicon, entry) of every segment with the token,
+        empty if none has it. a query finds them once per token and passes them to the
+        methods below, which find them again when they are not given
+        '''
+        entries = []
+        for segment, (lexicon, _, _) in enumerate(self.segments):
+            number, entry = lexicon.cached_find(token)
+            if entry is not None:
+                entries.append((segment, number, entry))
+        return entries
+
+    def doc_freq(self, token, entries=None):
+        '''
+        num of docs with the token that are not deleted, counted like num_docs so the
+        idf is the one the index has once update.py compacts it
+        '''
+        if entries is None:
+            entries = self.entries(token)
+        doc_freq = sum(entry[0] for _, _, entry in entries)
+        if self.any_deleted and doc_freq:
+            #postings of deleted docs stay until the index is compacted
+            doc_ids = self.posting_arrays(token, entries)[0]
+            doc_freq -= bytes(map(self.deleted.__getitem__, islice(doc_ids, len(doc_ids) - 1))).count(1)
+        return doc_freq
+
+    def idf(self, token, entries=None):
+        #a token only in deleted docs adds nothing to any doc left
+        doc_freq = self.doc_freq(token, entries)
+        return math.log(self.num_docs / doc_freq) if doc_freq else 0.0
+
+    def __contains__(self, token):
+        return bool(self.entries(token))
+
+    def expand(self, token):
+        '''
+        terms of every segment matching a token with * or ? wildcards, like inter*, in
+        term order. a token without wildcards is itself if it is in the index
+        '''
+        if not is_wildcard(token):
+            return [token] if token in self else []
+        terms = set()
+        for lexicon, _, _ in self.segments:
+            terms.update(islice(lexicon.wildcard(token), MAX_EXPANSIONS))
+        return sorted(terms)[:MAX_EXPANSIONS]
+
+    def postings(self, token, entries=None):
+        '''
+        (doc id, weight) of every posting of the token in every segment, weights are tf / norm
+        '''
+        #the doc ids have END after the last one, zip stops at the last weight
+        return zip(*self.posting_arrays(token, entries))
 
-def sum_document_similarity(dictionary, postings, query):
+    def max_weight(self, token, entries=None):
+        if entries is None:
+            entries = self.entries(token)
+        return max(entry[4] for _, _, entry in entries)
+
+    def posting_arrays(self, token, entries=None):
+        '''
+        doc ids and weights of the token in every segment as two arrays, doc ids are
+        increasing and followed by END. the arrays are shared through the cache, they
+        are not changed by the callers
+        '''
+        cached = self.postings_cache.get(token)
+        if cached is not None:
+            return cached
+        if entries is None:
+            entries = self.entries(token)
+        doc_ids, weights = array('i'), array('d')
+        with metrics.timer('postings_decode'):
+            for segment, _, entry in entries:
+                _, postings, first_doc = self.segments[segment]
+                segment_docs, segment_weights = postings.arrays(entry, first_doc)
+                doc_ids += segment_docs
+                weights += segment_weights
+        metrics.count('postings_decoded', len(doc_ids))
+        doc_ids.append(END)
+        self.postings_cache.put(token, (doc_ids, weights))
+        return doc_ids, weights
+
+    def positions(self, token, i, entries=None):
+        '''
+        positions of the token in the doc of posting i of posting_arrays
+        '''
+        if entries is None:
+            entries = self.entries(token)
+        for segment, number, entry in entries:
+            num_postings = entry[0]
+            if i < num_postings:
+                positions = self.segment_positions[segment]
+                if positions is None:
+                    raise ValueError('the index has no positions, it is built with phase3 index.py --positions')
+                return positions.read(number, num_postings, i)
+            i -= num_postings
+        raise IndexError(i)
+
+    def cache_stats(self):
+        #the lexicon caches of the segments added up
+        lexicon = [lexicon.cache.stats() for lexicon, _, _ in self.segments]
+        return {'postings': self.postings_cache.stats(), 'results': self.results_cache.stats(),
+                'lexicon': {key: sum(stats[key] for stats in lexicon) for key in lexicon[0]}}
+
+def load_inverted_index(index_dir='.', postings_cache_bytes=POSTINGS_CACHE_BYTES, results_cache_bytes=RESULTS_CACHE_BYTES,
+                        lexicon_cache_bytes=LEXICON_CACHE_BYTES):
+    '''
+    lexicon.bin and postings.bin of every segment are memory mapped instead of read
+    in the memory, docs.txt is the docs table of a segment. every lexicon keeps up to
+    lexicon_cache_bytes of the terms looked up
+    '''
+    if sys.byteorder == 'big':
+        raise OSError('the binary index is little endian')
+    segments = []
+    segment_positions = []
+    docs = []
+    deleted = bytearray()
+    tombstones = load_tombstones(index_dir)
+    for segment in load_segments(index_dir):
+        segment_dir = os.path.join(index_dir, segment)
+        segment_docs = load_docs(os.path.join(segment_dir, 'docs.txt'))
+        lexicon = Lexicon(os.path.join(segment_dir, 'lexicon.bin'), lexicon_cache_bytes)
+        postings = Postings(os.path.join(segment_dir, 'postings.bin'))
+        segments.append((lexicon, postings, len(docs)))
+        #positions.bin is only mapped here, plain queries never read it
+        pos_file = os.path.join(segment_dir, 'positions.bin')
+        segment_positions.append(Positions(pos_file) if os.path.exists(pos_file) else None)
+        docs += segment_docs
+        deleted += bytes((segment, doc) in tombstones for doc in range(len(segment_docs)))
+    return Index(segments, docs, deleted, postings_cache_bytes, results_cache_bytes, segment_positions)
+
+def top_k(scores, found, k=10):
+    '''
+    (doc id, score) of the k highest scores, only the found docs are ranked.
+    docs with the same score are ranked by doc id
+    '''
+    return [(doc, scores[doc]) for doc in heapq.nlargest(k, found, key=lambda doc: (scores[doc], -doc))]
+
+def printing_top_10(top, num_found, query, docs):
+    #doc ids are mapped back to file names only for the top 10
+    if num_found is None:
+        #document at a time skips docs, so it does not know how many were found
+        print(f'top {len(top)} documents for {query}')
+    else:
+        print(f'{query} was found in {num_found} documents')
+    for doc, score in top:
+        print(f'{docs[doc][0]}, {score}')
+
+def sum_document_similarity(index, query):
 
     '''
-    performing term at a time 
+    performing term at a time, returns the scores array indexed by doc id
+    and the ids of the documents that were found
     '''
-    found = {} #document scores
-   # tf_idf = {}
+    num_docs = len(index.docs)
+    scores = array('d', bytes(8 * num_docs)) #document scores, all 0.0
+    seen = bytearray(num_docs)
+    found = []
     #going term at a time
     for token in query:
-        #if the token from the query is in the dictionary file
-        if token in dictionary:
-            position_of_token = dictionary.index(token) #finding the location of the token in dictionary 
-            number_postings = int(dictionary[position_of_token + 1]) #one line below from token is num of postings
-            #print(number_postings)
-            start_pos_in_postings = int(dictionary[position_of_token + 2]) #2 lines below token is start pos in postings.txt
-            #print(type(start_pos_in_postings))
-            #find the documentid in posting.txt
-            documentid = postings[start_pos_in_postings: start_pos_in_postings + number_postings]
-            #print(documentid)
-            for word in documentid:
-
-                #here stripping off the comma from postings.txt.
-                (doc, score) = word.split(',')
+        #if the token from the query is in the lexicon of a segment
+        entries = index.entries(token)
+        if entries:
+            idf = index.idf(token, entries)
+            #find the documentid in postings.bin of every segment
+            for doc, weight in index.postings(token, entries):
                 #print(f"Processing doc: {doc}, score: {score}")
-                if doc in found:
-                  #  print(f'Doc {doc} already in dictionary, updating score')
-                    found[doc] += float(score)
-                else:
-                  #  print(f'Adding doc {doc} to dictionary')
-                    found[doc] = float(score)
-                    #print(found)
+                #deleted docs stay in postings.bin until the index is compacted
+                if index.deleted[doc]:
+                    continue
+                if not seen[doc]:
+                    seen[doc] = 1
+                    found.append(doc)
+                scores[doc] += weight * idf
                 #print(f'current score {score}')
         else:
             print('Query not in index')
-    printing_top_10(found, query)
+    return scores, found
+
+#upper bounds are summed in a different order than the scores, this covers the rounding
+BOUND_SLACK = 1 + 1e-9
+#doc ids scored at a time by maxscore_top_k
+BLOCK = 4096
+
+def maxscore_top_k(index, query, k=10):
+    '''
+    performing document at a time with MaxScore, returns the same (doc id, score) of
+    the k highest scores as top_k of sum_document_similarity. query tokens are sorted
+    by the max score they give any doc. once the lowest score in the heap of the top k
+    is more than the max scores of the first tokens added up, docs found only in those
+    tokens cannot make it to the top k, their postings are only binary searched for
+    the docs found in the other tokens. docs are visited in order a block of doc ids
+    at a time, the postings of the other tokens in the block are summed up together
+    '''
+    if k <= 0:
+        return []
+    tokens = []
+    #tokens not in the index are left out
+    for position, token in enumerate(query):
+        entries = index.entries(token)
+        if entries:
+            idf = index.idf(token, entries)
+            doc_ids, weights = index.posting_arrays(token, entries)
+            max_score = index.max_weight(token, entries) * idf
+            tokens.append((max_score, position, idf, doc_ids, weights))
+    in_query_order = sorted(tokens, key=lambda token: token[1])
+    tokens.sort(key=lambda token: token[0])
+    #bounds[j] is the max scores of the first j tokens added up
+    bounds = [0.0]
+    for max_score, _, _, _, _ in tokens:
+        bounds.append(bounds[-1] + max_score)
+    at = [0] * len(tokens) #next posting of every token
+    top = [] #heap of (score, -doc id), the worst of the top k first
+    threshold = -math.inf
+    essential = 0 #tokens from here on can put a doc in the top k by themselves
+    while essential < len(tokens):
+        block_start = min(tokens[j][3][at[j]] for j in range(essential, len(tokens)))
+        if block_start == END:
+            break
+        block_end = block_start + BLOCK
+        #scores of the docs of the block from the essential tokens
+        partial = {}
+        for j in range(essential, len(tokens)):
+            _, _, idf, doc_ids, weights = tokens[j]
+            stop = bisect_left(doc_ids, block_end, at[j])
+            for doc, weight in zip(doc_ids[at[j]:stop], weights[at[j]:stop]):
+                partial[doc] = partial.get(doc, 0.0) + weight * idf
+            at[j] = stop
+        block_essential = essential
+        for doc in sorted(partial):
+            score = partial[doc]
+            if index.deleted[doc] or (score + bounds[block_essential]) * BOUND_SLACK <= threshold:
+                continue
+            #the other tokens are looked up from the highest max score down while the doc can still make it
+            j = block_essential - 1
+            while j >= 0:
+                _, _, idf, doc_ids, weights = tokens[j]
+                at[j] = bisect_left(doc_ids, doc, at[j])
+                if doc_ids[at[j]] == doc:
+                    score += weights[at[j]] * idf
+                if (score + bounds[j]) * BOUND_SLACK <= threshold:
+                    break
+                j -= 1
+            if j >= 0:
+                continue
+            #the score is summed again in query order so it is the same float as sum_document_similarity
+            score = 0.0
+            for _, _, idf, doc_ids, weights in in_query_order:
+                i = bisect_left(doc_ids, doc)
+                if doc_ids[i] == doc:
+                    score += weights[i] * idf
+            #docs come in increasing doc id, a later doc with the same score ranks lower
+            if len(top) < k:
+                heapq.heappush(top, (score, -doc))
+            elif score > top[0][0]:
+                heapq.heapreplace(top, (score, -doc))
+            else:
+                continue
+            if len(top) == k:
+                threshold = top[0][0]
+                while essential < len(tokens) and bounds[essential + 1] * BOUND_SLACK <= threshold:
+                    essential += 1
+    return [(-doc, score) for score, doc in sorted(top, reverse=True)]
+
+def expand_query(index, query):
+    #wildcard tokens are replaced by the terms they match, which are scored like any other token
+    return [term for token in query for term in (index.expand(token) if is_wildcard(token) else (token,))]
+
+def phrase_words(query):
+    #split like phase3 splits the text of a doc, so the positions count the same words
+    return re.findall(r'\b[a-zA-Z]+\b', ' '.join(query).lower())
+
+def gallop(doc_ids, doc, low):
+    '''
+    index of the first doc id from low on that is not less than doc. steps 1, 2, 4...
+    ahead before the binary search, so a doc close to low takes a few steps. doc ids
+    end with END so the search always stops
+    '''
+    high, step = low, 1
+    while doc_ids[high] < doc:
+        low = high + 1
+        high = min(high + step, len(doc_ids) - 1)
+        step *= 2
+    return bisect_left(doc_ids, doc, low, high)
+
+def intersect(doc_id_lists):
+    '''
+    yields (doc id, index of the doc in every list) of the docs in every list, the lists
+    are doc ids of posting_arrays. the shortest list leads and the others gallop to its
+    docs, a doc missing from a list makes the shortest one gallop to the next doc of that list
+    '''
+    order = sorted(range(len(doc_id_lists)), key=lambda j: len(doc_id_lists[j]))
+    rarest = doc_id_lists[order[0]]
+    at = [0] * len(doc_id_lists)
+    i = 0
+    while rarest[i] != END:
+        doc = rarest[i]
+        for j in order[1:]:
+            at[j] = gallop(doc_id_lists[j], doc, at[j])
+            if doc_id_lists[j][at[j]] != doc:
+                i = gallop(rarest, doc_id_lists[j][at[j]], i + 1)
+                break
+        else:
+            at[order[0]] = i
+            yield doc, at
+            i += 1
+
+def phrase_match(index, terms, at, order):
+    '''
+    true if the words are at their offset in the phrase from the same start. the
+    starts of the rarest word are read first so most docs are dropped early
+    '''
+    starts = None
+    for j in order:
+        offset, word, _, _, _, entries = terms[j]
+        #a phrase starting with words not in the index can't start before the doc
+        word_starts = {position - offset for position in index.positions(word, at[j], entries) if position >= offset}
+        starts = word_starts if starts is None else starts & word_starts
+        if not starts:
+            return False
+    return True
+
+def near_match(index, terms, at, near):
+    '''
+    true if every word is at most near words from the word before it in the query,
+    before or after it. only the positions of a word close enough are kept
+    '''
+    reachable = index.positions(terms[0][1], at[0], terms[0][5])
+    for j in range(1, len(terms)):
+        close = array('i')
+        for position in index.positions(terms[j][1], at[j], terms[j][5]):
+            i = bisect_left(reachable, position - near)
+            if i < len(reachable) and reachable[i] <= position + near:
+                close.append(position)
+        if not close:
+            return False
+        reachable = close
+    return True
+
+def positional_top_k(index, query, k=10, near=None):
+    '''
+    (doc id, score) of the k highest scores of the docs with the words of query as a
+    phrase, in order and next to each other, or with near every word at most near words
+    from the word before it, and the num of docs found. words not in the index, like
+    stop words, match any word at their place in the phrase. docs with every word are
+    found by intersecting the doc ids first, positions are only read for those docs.
+    scores are the ones sum_document_similarity gives for the words in the index
+    '''
+    terms = [] #(offset in the phrase, word, idf, doc ids, weights, entries) of the words in the index
+    for offset, word in enumerate(phrase_words(query)):
+        entries = index.entries(word)
+        if entries:
+            doc_ids, weights = index.posting_arrays(word, entries)
+            terms.append((offset, word, index.idf(word, entries), doc_ids, weights, entries))
+    if not terms:
+        return [], 0
+    order = sorted(range(len(terms)), key=lambda j: len(terms[j][3]))
+    scores = {}
+    with metrics.timer('positions_match'):
+        for doc, at in intersect([doc_ids for _, _, _, doc_ids, _, _ in terms]):
+            if index.deleted[doc]:
+                continue
+            metrics.count('phrase_candidates')
+            if not (phrase_match(index, terms, at, order) if near is None else near_match(index, terms, at, near)):
+                continue
+            score = 0.0
+            for j, (_, _, idf, _, weights, _) in enumerate(terms):
+                score += weights[at[j]] * idf
+            scores[doc] = score
+    return top_k(scores, scores, k), len(scores)
+
+#operators of boolean queries, in capitals so and, or and not are still words
+BOOLEAN_OPERATORS = ('AND', 'OR', 'NOT')
+#the stop words phase3 leaves out of the index, read the first time a boolean query needs them
+STOP_WORDS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stopwords.txt')
+stop_words_set = None
+
+def boolean_words(query):
+    #words of a boolean query without the operators and parentheses
+    return [token.lower() for token in re.findall(r'[^\s()]+', query if isinstance(query, str) else ' '.join(query))
+            if token not in BOOLEAN_OPERATORS]
+
+def parse_boolean(query):
+    '''
+    tree of a boolean query given as a string or a list of words. the operators AND, OR
+    and NOT are in capitals so and, or and not are still words. AND binds tighter than
+    OR, NOT is for the word or the parentheses after it and words next to each other are
+    ANDed, so a query without operators finds the docs with every word. nodes are
+    ('word', word), ('not', node), ('and', nodes) and ('or', nodes)
+    '''
+    tokens = re.findall(r'[()]|[^\s()]+', query if isinstance(query, str) else ' '.join(query))
+    at = 0
+
+    def peek():
+        return tokens[at] if at < len(tokens) else None
+
+    def or_node():
+        nonlocal at
+        nodes = [and_node()]
+        while peek() == 'OR':
+            at += 1
+            nodes.append(and_node())
+        return nodes[0] if len(nodes) == 1 else ('or', nodes)
+
+    def and_node():
+        nonlocal at
+        nodes = [not_node()]
+        while peek() not in (None, 'OR', ')'):
+            if peek() == 'AND':
+                at += 1
+            nodes.append(not_node())
+        return nodes[0] if len(nodes) == 1 else ('and', nodes)
+
+    def not_node():
+        nonlocal at
+        if peek() == 'NOT':
+            at += 1
+            return ('not', not_node())
+        token = peek()
+        if token in (None, 'AND', 'OR', ')'):
+            raise ValueError(f'a word is missing before {token or "the end of the query"}')
+        at += 1
+        if token != '(':
+            return ('word', token.lower())
+        node = or_node()
+        if peek() != ')':
+            raise ValueError('a ) is missing')
+        at += 1
+        return node
+
+    tree = or_node()
+    if at < len(tokens):
+        raise ValueError(f'{tokens[at]} without a (')
+    return tree
+
+def union(doc_id_lists):
+    #doc ids in any of the lists, every list ends with END
+    docs = array('i')
+    for doc in heapq.merge(*(doc_ids[:-1] for doc_ids in doc_id_lists)):
+        if not docs or docs[-1] != doc:
+            docs.append(doc)
+    docs.append(END)
+    return docs
+
+def difference(doc_ids, excluded):
+    '''
+    doc ids not in any of the excluded lists. the excluded lists are galloped
+    through once, so a long one costs about as much as doc_ids
+    '''
+    at = [0] * len(excluded)
+    docs = array('i')
+    for doc in doc_ids[:-1]:
+        for j, other in enumerate(excluded):
+            at[j] = gallop(other, doc, at[j])
+            if other[at[j]] == doc:
+                break
+        else:
+            docs.append(doc)
+    docs.append(END)
+    return docs
+
+def evaluate(index, node, entries):
+    '''
+    increasing doc ids of the docs matching a node of parse_boolean followed by END, like
+    the doc ids of posting_arrays. the lists of an AND are intersected from the shortest,
+    its NOT nodes are taken out of the result instead of being made into lists of every doc.
+    the index entries of every word are put in entries for scoring the docs after
+    '''
+    kind = node[0]
+    if kind == 'word':
+        word = node[1]
+        if word not in entries:
+            entries[word] = index.entries(word)
+        return index.posting_arrays(word, entries[word])[0] if entries[word] else array('i', (END,))
+    if kind == 'or':
+        return union([evaluate(index, child, entries) for child in node[1]])
+    children = [node] if kind == 'not' else node[1]
+    included = [evaluate(index, child, entries) for child in children if child[0] != 'not']
+    excluded = [evaluate(index, child[1], entries) for child in children if child[0] == 'not']
+    if included:
+        docs = array('i', (doc for doc, _ in intersect(included)))
+    else:
+        #only NOT, every doc but the deleted ones
+        docs = array('i', (doc for doc in range(len(index.docs)) if not index.deleted[doc]))
+    docs.append(END)
+    return difference(docs, excluded)
+
+def indexed_words(node):
+    '''
+    node of parse_boolean without the words phase3 never indexes, stop words and single
+    letters, so `rust the cargo` finds the docs with rust and cargo. an AND, OR or NOT
+    left without words is dropped too, None when no word is left
+    '''
+    global stop_words_set
+    if stop_words_set is None:
+        with open(STOP_WORDS_FILE, 'r') as f:
+            stop_words_set = {line.strip() for line in f}
+    kind = node[0]
+    if kind == 'word':
+        word = node[1]
+        return node if is_wildcard(word) or (word not in stop_words_set and len(word) > 1) else None
+    if kind == 'not':
+        child = indexed_words(node[1])
+        return None if child is None else ('not', child)
+    children = [child for child in map(indexed_words, node[1]) if child is not None]
+    if len(children) <= 1:
+        return children[0] if children else None
+    return (kind, children)
+
+def expand_words(index, node):
+    #a wildcard word of a boolean query is the OR of the terms it matches
+    kind = node[0]
+    if kind == 'word':
+        return ('or', [('word', term) for term in index.expand(node[1])]) if is_wildcard(node[1]) else node
+    if kind == 'not':
+        return ('not', expand_words(index, node[1]))
+    return (kind, [expand_words(index, child) for child in node[1]])
+
+def scored_words(node, negated=False):
+    #words of the query that are not under a NOT, in query order
+    kind = node[0]
+    if kind == 'word':
+        return [] if negated else [node[1]]
+    if kind == 'not':
+        return scored_words(node[1], not negated)
+    return [word for child in node[1] for word in scored_words(child, negated)]
+
+def boolean_top_k(index, query, k=10):
+    '''
+    (doc id, score) of the k highest scores of the docs matching the boolean query of
+    parse_boolean, and the num of docs found. deleted docs are left out. scores are the
+    ones sum_document_similarity gives for the words that are not under a NOT. a query of
+    only stop words finds nothing
+    '''
+    tree = indexed_words(parse_boolean(query))
+    if tree is None:
+        return [], 0
+    tree = expand_words(index, tree)
+    entries = {} #index entries of every word, found once
+    with metrics.timer('boolean_match'):
+        docs = evaluate(index, tree, entries)
+    terms = [(index.idf(word, entries[word]),) + index.posting_arrays(word, entries[word])
+             for word in scored_words(tree) if entries[word]]
+    at = [0] * len(terms)
+    scores = {}
+    for doc in docs[:-1]:
+        if index.deleted[doc]:
+            continue
+        score = 0.0
+        for j, (idf, doc_ids, weights) in enumerate(terms):
+            at[j] = gallop(doc_ids, doc, at[j])
+            if doc_ids[at[j]] == doc:
+                score += weights[at[j]] * idf
+        scores[doc] = score
+    return top_k(scores, scores, k), len(scores)
+
+def cached_top_k(index, query, k=10, phrase=False, near=None, boolean=False):
+    '''
+    maxscore_top_k with the results of queries asked before kept in the results cache.
+    queries are the same if they have the same tokens in the same order. with phrase
+    or near the query is a phrase or near query of positional_top_k, with boolean a
+    query of boolean_top_k. wildcard tokens are expanded to the terms they match
+    '''
+    key = (tuple(query), k, phrase, near, boolean)
+    top = index.results_cache.get(key)
+    if top is None:
+        with metrics.timer('query'):
+            if boolean:
+                top, _ = boolean_top_k(index, query, k)
+            elif phrase or near is not None:
+                top, _ = positional_top_k(index, query, k, near)
+            else:
+                top = maxscore_top_k(index, expand_query(index, query), k)
+        index.results_cache.put(key, top)
+    metrics.count('queries')
+    return top
 
 if __name__ == "__main__":
-    dictionary, postings = load_inverted_index()
+    index = load_inverted_index()
 
-    arguments = len(sys.argv)
+    #--exhaustive scores every found doc term at a time instead, --metrics prints the time
+    #of every stage at the end and --prometheus prints it for prometheus. --phrase finds
+    #the query as a phrase and --near=k the words at most k words apart, both need an
+    #index built with phase3 index.py --positions. --boolean takes AND, OR, NOT and
+    #parentheses, in capitals, and --and finds the docs with every word. a token with *
+    #or ? is replaced by the terms it matches, like inter*, --terms only lists them
+    exhaustive = '--exhaustive' in sys.argv
+    terms = '--terms' in sys.argv
+    boolean = '--boolean' in sys.argv
+    conjunctive = '--and' in sys.argv
+    phrase = '--phrase' in sys.argv
+    near = next((int(arg.split('=', 1)[1]) for arg in sys.argv if arg.startswith('--near=')), None)
+    prometheus = '--prometheus' in sys.argv
+    metrics.enable('--metrics' in sys.argv or prometheus)
+    args = [arg for arg in sys.argv if arg not in ('--exhaustive', '--terms', '--boolean', '--and', '--phrase',
+                                                  '--metrics', '--prometheus') and not arg.startswith('--near=')]
+    arguments = len(args)
+    usage = ("Use `python3 retrieval.py query-here [--exhaustive|--terms|--boolean|--and|--phrase|--near=k] "
+             "[--metrics|--prometheus]`")
     if arguments < 2:
-        print("Use `python3 retrieval.py query-here`")
+        print(usage)
     #storing the query
     query = []
     for i in range(1, arguments):
         #lowercasing the query
-        word = sys.argv[i].lower()
+        word = args[i].lower()
         query.append(word)
     start = time.time()
     #query = ' '.join(query)
-    sum_document_similarity(dictionary, postings, query)
+    if terms:
+        for token in query:
+            print(f'{token}: {" ".join(index.expand(token))}')
+    elif exhaustive:
+        with metrics.timer('exhaustive_query'):
+            scores, found = sum_document_similarity(index, expand_query(index, query))
+            top = top_k(scores, found)
+        printing_top_10(top, len(found), query, index.docs)
+    elif boolean or conjunctive:
+        #the operators of a boolean query are only known before lowercasing
+        try:
+            with metrics.timer('query'):
+                top, num_found = boolean_top_k(index, args[1:] if boolean else query)
+        except ValueError as e:
+            #a malformed query, like a missing ( or a word missing next to an operator
+            print(f'Malformed query: {e}')
+            print(usage)
+            sys.exit(2)
+        printing_top_10(top, num_found, args[1:] if boolean else query, index.docs)
+    elif phrase or near is not None:
+        with metrics.timer('query'):
+            top, num_found = positional_top_k(index, query, near=near)
+        printing_top_10(top, num_found, query, index.docs)
+    else:
+        for token in query:
+            if not index.expand(token):
+                print('Query not in index')
+        with metrics.timer('query'):
+            top = maxscore_top_k(index, expand_query(index, query))
+        printing_top_10(top, None, query, index.docs)
     end = time.time()
-    print(f'Total time for query: {end-start}')
\ No newline at end of file
+    print(f'Total time for query: {end-start}')
+    if metrics.enabled:
+        print(metrics.dump(prometheus), end='')
\ No newline at end of file
@@ -0,0 +1,254 @@
+import os
+import sys
+import json
+import signal
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+from retrieval import (MANIFEST, TOMBSTONES, POSTINGS_CACHE_BYTES, RESULTS_CACHE_BYTES, LEXICON_CACHE_BYTES,
+                       load_inverted_index, cached_top_k, boolean_words)
+import metrics
+
+#resident query service, the index is loaded once and queries are answered over http
+#on a local port or a unix socket, or through QueryService from python.
+#
+#  GET  /search?q=computer+science&k=10    one query
+#  POST /search {"queries": [...], "k": 10} a batch of queries, strings or lists of tokens
+#  GET  /search?q=new+york&phrase=1        the query as a phrase, near=3 for words at most 3
+#                                          words apart. POST takes "phrase" and "near" too,
+#                                          both need an index built with --positions
+#  GET  /search?q=a+AND+(b+OR+NOT+c)&boolean=1   a boolean query, POST takes "boolean" too
+#  GET  /search?q=inter*                   a token with * or ? is every term it matches
+#  POST /reload {"index_dir": "..."}        loads the index again, from another dir if given
+#  GET  /stats                             hits and misses of the postings and results caches
+#  GET  /metrics                           stage timers and counters for prometheus, with --metrics
+#
+#index.py rewrites the files of an index dir in place, so a new index should be built in
+#another dir and reloaded from there. segments added by phase3 update.py are reloaded by
+#themselves, update.py never changes files the server has memory mapped
+
+#num of threads running queries
+WORKERS = os.cpu_count() or 1
+#seconds between checks for segments added or docs deleted by update.py
+RELOAD_CHECK = 2.0
+#biggest request body read
+MAX_BODY = 16 * 1024 * 1024
+DEFAULT_K = 10
+
+def parse_query(query, boolean=False):
+    #lowercasing the query like the command line does, the AND, OR and NOT of a boolean
+    #query stay in capitals and parse_boolean lowercases its words
+    if isinstance(query, str):
+        query = query.split()
+    return list(query) if boolean else [word.lower() for word in query]
+
+class QueryService:
+    '''
+    an index loaded once with a pool of threads to run queries on it. a query
+    takes the index it runs on when it starts, reload swaps in a new index for
+    the queries started after it and the old one is freed once they are done.
+    the caches belong to the index so a reload starts with empty caches
+    '''
+    def __init__(self, index_dir='.', workers=WORKERS, postings_cache_bytes=POSTINGS_CACHE_BYTES,
+                 results_cache_bytes=RESULTS_CACHE_BYTES, lexicon_cache_bytes=LEXICON_CACHE_BYTES):
+        self.index_dir = index_dir
+        self.cache_bytes = (postings_cache_bytes, results_cache_bytes, lexicon_cache_bytes)
+        self.index = load_inverted_index(index_dir, *self.cache_bytes)
+        self.version = self.index_version()
+        self.executor = ThreadPoolExecutor(workers)
+
+    def index_version(self):
+        #update.py replaces segments.txt and tombstones.txt, each build writes docs.txt
+        version = []
+        for name in (MANIFEST, TOMBSTONES, 'docs.txt'):
+            path = os.path.join(self.index_dir, name)
+            version.append(os.stat(path).st_mtime_ns if os.path.exists(path) else None)
+        return version
+
+    def search(self, query, k=DEFAULT_K, phrase=False, near=None, boolean=False):
+        index = self.index
+        query = parse_query(query, boolean)
+        top = cached_top_k(index, query, k, phrase, near, boolean)
+        return {'query': query,
+                'missing': [token for token in (boolean_words(query) if boolean else query) if not index.expand(token)],
+                'results': [{'doc': index.docs[doc][0], 'score': score} for doc, score in top]}
+
+    def search_batch(self, queries, k=DEFAULT_K, phrase=False, near=None, boolean=False):
+        return list(self.executor.map(lambda query: self.search(query, k, phrase, near, boolean), queries))
+
+    def reload(self, index_dir=None):
+        '''
+        loads the index again, from index_dir if given
+        '''
+        index_dir = index_dir or self.index_dir
+        index = load_inverted_index(index_dir, *self.cache_bytes)
+        self.index_dir = index_dir
+        self.index = index
+        self.version = self.index_version()
+
+    def reload_if_changed(self):
+        if self.index_version() != self.version:
+            self.reload()
+            return True
+        return False
+
+    async def search_async(self, queries, k=DEFAULT_K, phrase=False, near=None, boolean=False):
+        #the queries of a batch run at the same time in the thread pool
+        loop = asyncio.get_running_loop()
+        return await asyncio.gather(*(loop.run_in_executor(self.executor, self.search, query, k, phrase, near, boolean)
+                                      for query in queries))
+
+    async def reload_async(self, index_dir=None):
+        #queries keep running on the old index while the new one loads
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.reload, index_dir)
+
+    def close(self):
+        self.executor.shutdown()
+
+async def read_request(reader):
+    '''
+    (method, target, headers, body) of an http request, None once the client is gone
+    '''
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, target, _ = request_line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    if length > MAX_BODY:
+        raise ValueError('request body too big')
+    body = await reader.readexactly(length) if length else b''
+    return method, target, headers, body
+
+def write_response(writer, status, content, keep_alive):
+    #text is sent as it is, everything else as json
+    if isinstance(content, str):
+        body, content_type = content.encode('utf-8'), 'text/plain; version=0.0.4'
+    else:
+        body, content_type = json.dumps(content).encode('utf-8'), 'application/json'
+    reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}[status]
+    writer.write(f'HTTP/1.1 {status} {reason}\r\nContent-Type: {content_type}\r\n'
+                 f'Content-Length: {len(body)}\r\nConnection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode('latin-1'))
+    writer.write(body)
+
+def positive_k(k):
+    #a bad k is a 400 like the other bad params
+    k = int(k)
+    if k <= 0:
+        raise ValueError(f'k is {k}, it has to be at least 1')
+    return k
+
+async def route(service, method, target, body):
+    url = urlsplit(target)
+    params = parse_qs(url.query)
+    if url.path == '/search' and method == 'GET':
+        k = positive_k(params.get('k', [DEFAULT_K])[0])
+        phrase = params.get('phrase', ['0'])[0].lower() in ('1', 'true')
+        near = int(params['near'][0]) if 'near' in params else None
+        boolean = params.get('boolean', ['0'])[0].lower() in ('1', 'true')
+        results = await service.search_async([params.get('q', [''])[0]], k, phrase, near, boolean)
+        return 200, results[0]
+    if url.path == '/search' and method == 'POST':
+        request = json.loads(body or b'{}')
+        near = int(request['near']) if request.get('near') is not None else None
+        results = await service.search_async(request['queries'], positive_k(request.get('k', DEFAULT_K)),
+                                             bool(request.get('phrase', False)), near,
+                                             bool(request.get('boolean', False)))
+        return 200, {'results': results}
+    if url.path == '/reload' and method == 'POST':
+        request = json.loads(body or b'{}')
+        await service.reload_async(request.get('index_dir'))
+        return 200, {'index_dir': service.index_dir, 'num_docs': len(service.index.docs)}
+    if url.path == '/stats' and method == 'GET':
+        return 200, service.index.cache_stats()
+    if url.path == '/metrics' and method == 'GET':
+        return 200, metrics.dump_prometheus()
+    return 404, {'error': f'no {method} {url.path}'}
+
+async def handle_client(service, reader, writer):
+    try:
+        while True:
+            try:
+                request = await read_request(reader)
+            except (ValueError, asyncio.IncompleteReadError) as error:
+                write_response(writer, 400, {'error': str(error)}, False)
+                break
+            if request is None:
+                break
+            method, target, headers, body = request
+            keep_alive = headers.get('connection', '').lower() != 'close'
+            try:
+                status, content = await route(service, method, target, body)
+            except (ValueError, KeyError, TypeError) as error:
+                status, content = 400, {'error': f'bad request: {error}'}
+            except Exception as error:
+                status, content = 500, {'error': str(error)}
+            write_response(writer, status, content, keep_alive)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def watch_index(service):
+    #picks up segments and deletes from update.py without a reload request
+    while True:
+        await asyncio.sleep(RELOAD_CHECK)
+        try:
+            await asyncio.get_running_loop().run_in_executor(service.executor, service.reload_if_changed)
+        except (OSError, ValueError) as error:
+            #update.py may be halfway through swapping files, tried again next time
+            print(f'Could not reload the index: {error}')
+
+async def serve(service, port=None, socket_path=None):
+    '''
+    serves http on localhost port, or on the unix socket at socket_path
+    '''
+    handler = lambda reader, writer: handle_client(service, reader, writer)
+    if socket_path is not None:
+        #a socket file left by a server that was killed
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = await asyncio.start_unix_server(handler, socket_path)
+    else:
+        server = await asyncio.start_server(handler, '127.0.0.1', port)
+    loop = asyncio.get_running_loop()
+    #kill -HUP reloads the index like POST /reload
+    loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(service.reload_async()))
+    watcher = asyncio.ensure_future(watch_index(service))
+    print(f'Serving {service.index_dir} on {socket_path or f"http://127.0.0.1:{port}"}')
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        watcher.cancel()
+
+if __name__ == "__main__":
+
+    #--metrics records the time of the stages of every query for GET /metrics
+    metrics.enable('--metrics' in sys.argv)
+    args = [arg for arg in sys.argv if arg != '--metrics']
+    if len(args) < 2:
+        print("Use python3 server.py index-dir [port|socket-path] [--metrics]")
+        sys.exit(2)
+
+    index_dir = args[1]
+    address = args[2] if len(args) > 2 else '8080'
+    service = QueryService(index_dir)
+    try:
+        if address.isdigit():
+            asyncio.run(serve(service, port=int(address)))
+        else:
+            asyncio.run(serve(service, socket_path=address))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
@@ -3,12 +3,15 @@ import sys
 import time
 import re
 import math
-import pandas as pd
+import codecs
+import multiprocessing
+from html.entities import html5
+from html.parser import HTMLParser
 import numpy as np
+from array import array
 from collections import defaultdict
-from bs4 import BeautifulSoup
-from scipy.cluster.hierarchy import linkage, fcluster
-from sklearn.metrics.pairwise import cosine_similarity
+from scipy import sparse
+import metrics
 
 def get_filenames(input_dir):
     filenames = []
@@ -19,108 +22,427 @@ def get_filenames(input_dir):
     return filenames
 
 
-def parse(input_dir, stop_words_set):
+#text of these tags is left out by BeautifulSoup's get_text()
+HIDDEN_TAGS = {'script', 'style', 'template', 'rt', 'rp'}
+#tags BeautifulSoup closes as soon as they are opened
+VOID_TAGS = {'area', 'base', 'basefont', 'bgsound', 'br', 'col', 'command', 'embed', 'frame', 'hr', 'image',
+             'img', 'input', 'isindex', 'keygen', 'link', 'menuitem', 'meta', 'nextid', 'param', 'source',
+             'spacer', 'track', 'wbr'}
+#named entities without their semicolon, the same way BeautifulSoup looks them up
+ENTITIES = {}
+for name, character in sorted(html5.items()):
+    ENTITIES.setdefault(name.rstrip(';'), character)
+#bytes read from an html file at a time by the fast path
+READ_SIZE = 65536
+
+class TextExtractor(HTMLParser):
+    '''
+    fast path for BeautifulSoup(fp, 'html.parser').get_text(), keeps the text
+    the same way without building the tree. only the names of the open tags
+    are kept to know when the text is inside a hidden tag
+    '''
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.open_tags = []
+        self.hidden = 0 #num of open hidden tags
+        self.pieces = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in VOID_TAGS:
+            return
+        self.open_tags.append(tag)
+        if tag in HIDDEN_TAGS:
+            self.hidden += 1
+
+    def handle_endtag(self, tag):
+        #like BeautifulSoup, closes every tag opened after the last open tag with this name
+        if tag not in self.open_tags:
+            return
+        i = len(self.open_tags) - 1 - self.open_tags[::-1].index(tag)
+        self.hidden -= sum(1 for name in self.open_tags[i:] if name in HIDDEN_TAGS)
+        del self.open_tags[i:]
+
+    def handle_data(self, data):
+        if not self.hidden:
+            self.pieces.append(data)
+
+    def handle_entityref(self, name):
+        self.handle_data(ENTITIES.get(name, f'&{name}'))
+
+    def handle_charref(self, name):
+        code = int(name[1:], 16) if name[:1] in 'xX' else int(name)
+        character = None
+        #references below 256 are read as windows-1252 first, like BeautifulSoup
+        if code < 256:
+            try:
+                character = bytes([code]).decode('windows-1252')
+            except UnicodeDecodeError:
+                pass
+        if character is None:
+            try:
+                character = chr(code)
+            except (ValueError, OverflowError):
+                character = '\ufffd'
+        self.handle_data(character)
+
+    def unknown_decl(self, data):
+        #BeautifulSoup keeps the text of CDATA sections even inside hidden tags
+        if data.upper().startswith('CDATA['):
+            self.pieces.append(data[len('CDATA['):])
+
+def extract_text(file):
+    '''
+    streams the bytes of file through TextExtractor and returns the text
+    '''
+    extractor = TextExtractor()
+    #Deals with UnicodeDecodeError
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+    with open(file, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(READ_SIZE), b''):
+            extractor.feed(decoder.decode(chunk))
+    extractor.feed(decoder.decode(b'', final=True))
+    extractor.close()
+    return ''.join(extractor.pieces)
+
+def get_text(file, fast=False):
+    if fast:
+        return extract_text(file)
+    #imported here so the fast path and the other commands start without it
+    from bs4 import BeautifulSoup
+    #Deals with UnicodeDecodeError
+    with open(file, 'r', encoding='utf-8', errors='ignore') as fp:
+        soup = BeautifulSoup(fp, 'html.parser')
+        return soup.get_text()
+
+#num of processes parsing html and num of files sent to a process at a time
+WORKERS = os.cpu_count() or 1
+CHUNKSIZE = 16
+
+#stop words and text extraction of a worker process, set once by init_worker instead of sent with every file
+worker_stop_words = set()
+worker_fast = False
+
+def init_worker(stop_words_set, fast=False, measure=False):
+    global worker_stop_words, worker_fast
+    worker_stop_words = stop_words_set
+    worker_fast = fast
+    metrics.enable(measure)
+
+def count_tokens(file):
+    with metrics.timer('html_parse'):
+        text = get_text(file, worker_fast)
+    with metrics.timer('regex_tokenize'):
+        stripped = re.findall(r'\b[a-zA-Z]+\b', text.lower())
+
+    with metrics.timer('stopword_filter'):
+        tokens = [token for token in stripped if token not in worker_stop_words and len(token) > 1]
+    token_count = {}
+    for token in tokens:
+        token_count[token] = token_count.get(token, 0) + 1
+    metrics.observe('doc_tokens', len(tokens))
+    return file, token_count
+
+def count_tokens_measured(file):
+    #metrics of a worker process go back to the main process with every file
+    return count_tokens(file), metrics.take()
+
+def tokenize_files(files, stop_words_set, workers=WORKERS, chunksize=CHUNKSIZE, ordered=True, fast=False):
+    '''
+    parses and tokenizes the files in a pool of worker processes, chunksize
+    files at a time. yields (file, token counts) of every file, in the order of
+    files if ordered else as soon as a worker is done with it. fast uses
+    extract_text instead of BeautifulSoup
+    '''
+    if workers <= 1:
+        init_worker(stop_words_set, fast, metrics.enabled)
+        yield from map(count_tokens, files)
+        return
+    with multiprocessing.Pool(workers, init_worker, (stop_words_set, fast, metrics.enabled)) as pool:
+        results = pool.imap if ordered else pool.imap_unordered
+        if not metrics.enabled:
+            yield from results(count_tokens, files, chunksize)
+            return
+        for result, recorded in results(count_tokens_measured, files, chunksize):
+            metrics.merge(recorded)
+            yield result
+
+def parse(input_dir, stop_words_set, workers=WORKERS, fast=False):
 
     files = get_filenames(input_dir)
     #used to store token frequency and avoids checks for existence of a key in a dict
     #outer dictionary are tokens, values of the tokens are in the inner
     token_freq = {}
     document_freq = defaultdict(int)
-    for file in files:
-        #Deals with UnicodeDecodeError
-        with open(file, 'r', encoding='utf-8', errors='ignore') as fp:
-            soup = BeautifulSoup(fp, 'html.parser')
-            text = soup.get_text()
-
-            stripped = re.findall(r'\b[a-zA-Z]+\b', text.lower())
-
-            tokens = [token for token in stripped if token not in stop_words_set and len(token) > 1]
-            for token in tokens:
-                if token not in token_freq:
-                    #create empty inner dict if token has not been encountered
-                    token_freq[token] = {} 
-                if file not in token_freq[token]:
-                    token_freq[token][file] = 0  #default value is 0
-                token_freq[token][file] += 1
-            
-            #used a set to not count duplicates as it resulted in negative TF-IDF
-            #keeps track of num of documents contain a certain token
-            for token in set(tokens):
-                document_freq[token]+=1
-
-            #removing tokens that appear once in corpus
-            appear_once = [token for token in token_freq if document_freq[token] == 1]
-            for token in appear_once:
-                del token_freq[token]
+    #results are kept in the order of files so the rows of the matrix are too
+    for file, token_count in tokenize_files(files, stop_words_set, workers, fast=fast):
+        for token, amount in token_count.items():
+            if token not in token_freq:
+                #create empty inner dict if token has not been encountered
+                token_freq[token] = {} 
+            token_freq[token][file] = amount
+
+        #token_count holds every token once, counting duplicates resulted in negative TF-IDF
+        #keeps track of num of documents contain a certain token
+        for token in token_count:
+            document_freq[token]+=1
+
+    #removing tokens that appear once in corpus, once after the single pass
+    #over the documents instead of scanning token_freq after every document
+    appear_once = [token for token in token_freq if document_freq[token] == 1]
+    for token in appear_once:
+        del token_freq[token]
     return token_freq, document_freq
 
-def tf_idf_matrix(tf, idf):
-    doc_set = set()
-    for i in tf.values():
-        for j in i.keys():
-            doc_set.add(j)
-    N = len(doc_set)
+def tf_idf_matrix(tf, df, dtype=np.float64):
+    '''
+    l2 normalized tf-idf of every doc as a CSR sparse matrix with a row per doc and
+    a column per token, only the non zeros are stored. returns the matrix and the
+    doc of every row. rows are in the order docs are first found going through tf
+    '''
+    #row of every doc
+    rows = {}
+    for docs in tf.values():
+        for doc in docs:
+            if doc not in rows:
+                rows[doc] = len(rows)
+    N = len(rows)
 
-    #calculating tf_idf
-    tf_idf = {}
-    for token, docs in tf.items():
+    #calculating tf_idf, one (row, column, value) per non zero
+    row_ids = array('i')
+    column_ids = array('i')
+    values = array('d')
+    for column, (token, docs) in enumerate(tf.items()):
         df_t = df[token]
         idf_t = math.log(N / (1 + df_t))
         for doc, freq in docs.items():
-            tf_t_d = freq / len(docs) 
+            tf_t_d = freq / len(docs)
             tf_idf_t_d = tf_t_d * idf_t
-            if doc not in tf_idf:
-                tf_idf[doc] = {}
-            tf_idf[doc][token] = tf_idf_t_d
+            row_ids.append(rows[doc])
+            column_ids.append(column)
+            values.append(tf_idf_t_d)
 
-    #normalizing the tf_idf
-    tf_idf = pd.DataFrame.from_dict(tf_idf, orient='index').fillna(0)
-    norms = np.linalg.norm(tf_idf.values, axis=1, keepdims=True)
-    tf_idf_normalized = tf_idf.values / norms
-    tf_idf_normalized = pd.DataFrame(tf_idf_normalized, index=tf_idf.index, columns=tf_idf.columns)
-    return tf_idf_normalized
+    tf_idf = sparse.csr_matrix((np.frombuffer(values, dtype=np.float64).astype(dtype),
+                                (np.frombuffer(row_ids, dtype=np.int32), np.frombuffer(column_ids, dtype=np.int32))),
+                               shape=(N, len(tf)))
+    #sklearn takes longer to import than the rest of the modules together, so only
+    #the functions that use it import it
+    from sklearn.preprocessing import normalize
+    #normalizing the tf_idf, rows that are all zeros are left as they are
+    tf_idf_normalized = normalize(tf_idf, norm='l2', copy=False)
+    return tf_idf_normalized, list(rows)
+
+#bytes of the rows of the similarity matrix computed at a time, a row is num of docs float64s
+BLOCK_BYTES = 64 * 1024 * 1024
+
+def block_rows(num_docs, block_bytes=BLOCK_BYTES):
+    #rows of a block that fit in block_bytes, at least one
+    return max(1, block_bytes // (8 * max(num_docs, 1)))
+
+def similarity_blocks(tfidf_matrix, block_bytes=BLOCK_BYTES):
+    '''
+    yields (first row, dense block of rows) of the cosine similarity of every pair of docs.
+    rows are normalized so the dot products are the cosine similarity, multiplied as
+    sparse matrices so only tokens both docs have are visited. the diagonal is 0 like
+    the pairs loop left it. memory is one block of about block_bytes at a time
+    '''
+    num_docs = tfidf_matrix.shape[0]
+    block_size = block_rows(num_docs, block_bytes)
+    transposed = tfidf_matrix.T.tocsc()
+    for start in range(0, num_docs, block_size):
+        end = min(start + block_size, num_docs)
+        block = (tfidf_matrix[start:end] @ transposed).toarray().astype(np.float64, copy=False)
+        block[np.arange(end - start), np.arange(start, end)] = 0
+        yield start, block
+
+def similarity_matrix(tfidf_matrix, block_bytes=BLOCK_BYTES):
+    num_docs = tfidf_matrix.shape[0]
+    matrix = np.empty((num_docs, num_docs))
+    for start, block in similarity_blocks(tfidf_matrix, block_bytes):
+        matrix[start:start + len(block)] = block
+    return matrix
+
+def extremal_pairs(blocks):
+    '''
+    (i, j) of the most similar and of the most dissimilar pair of docs with i < j,
+    searched a block of rows at a time. the first pair in row order wins a tie
+    '''
+    max_similarity, most_similar_pair = -1, ()
+    min_similarity, most_dissimilar_pair = 1, ()
+    for start, block in blocks:
+        rows = np.arange(start, start + len(block))[:, None]
+        upper = np.arange(block.shape[1])[None, :] > rows
+        #argmax and argmin give the first of equal values in row order
+        i, j = np.unravel_index(np.argmax(np.where(upper, block, -np.inf)), block.shape)
+        if upper[i, j] and block[i, j] > max_similarity:
+            max_similarity, most_similar_pair = block[i, j], (int(start + i), int(j))
+        i, j = np.unravel_index(np.argmin(np.where(upper, block, np.inf)), block.shape)
+        if upper[i, j] and block[i, j] < min_similarity:
+            min_similarity, most_dissimilar_pair = block[i, j], (int(start + i), int(j))
+    return most_similar_pair, most_dissimilar_pair
+
+#scalable clustering: docs are split by spherical k-means into BRANCHING parts at a time until
+#every part has at most MAX_LEAF docs, then each part is clustered with complete linkage
+BRANCHING = 16
+MAX_LEAF = 2000
+#docs a mini-batch k-means step looks at and max num of steps, smaller parts get steps
+#for about PASSES passes over their docs but at least MIN_ITERATIONS steps
+BATCH_SIZE = 1024
+KMEANS_ITERATIONS = 100
+PASSES = 3
+MIN_ITERATIONS = 10
+
+def spherical_kmeans(tfidf_matrix, k, rng, batch_size=BATCH_SIZE, iterations=KMEANS_ITERATIONS):
+    '''
+    mini-batch k-means on the unit length rows with cosine similarity, centroids are
+    moved towards the mean of their docs in a batch and normalized after every step.
+    returns the centroid each row is the most similar to
+    '''
+    num_docs = tfidf_matrix.shape[0]
+    #centroids only need the tokens these docs have
+    tfidf_matrix = tfidf_matrix[:, np.unique(tfidf_matrix.indices)]
+    centroids = tfidf_matrix[rng.choice(num_docs, k, replace=False)].toarray()
+    counts = np.zeros(k)
+    #small parts are gone over a few times instead of iterations times
+    iterations = min(iterations, max(MIN_ITERATIONS, PASSES * num_docs // batch_size))
+    for _ in range(iterations):
+        batch = tfidf_matrix[rng.choice(num_docs, min(batch_size, num_docs), replace=False)]
+        nearest = np.asarray(batch @ centroids.T).argmax(axis=1)
+        #sums of the docs of every centroid in the batch, as one sparse product
+        members = sparse.csr_matrix((np.ones(len(nearest)), (nearest, np.arange(len(nearest)))), shape=(k, len(nearest)))
+        sums = (members @ batch).toarray()
+        batch_counts = np.bincount(nearest, minlength=k)
+        counts += batch_counts
+        #each centroid learns slower the more docs it has seen, centroids without docs in the batch stay
+        moved = batch_counts > 0
+        rate = batch_counts[moved] / counts[moved]
+        centroids[moved] = (1 - rate)[:, None] * centroids[moved] + (rate / batch_counts[moved])[:, None] * sums[moved]
+        norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+        np.divide(centroids, norms, out=centroids, where=norms > 0)
+    labels = np.empty(num_docs, dtype=np.int64)
+    for start in range(0, num_docs, batch_size):
+        labels[start:start + batch_size] = np.asarray(tfidf_matrix[start:start + batch_size] @ centroids.T).argmax(axis=1)
+    return labels
+
+def partition(tfidf_matrix, rows, rng):
+    '''
+    splits rows with spherical k-means until every part has at most MAX_LEAF docs
+    '''
+    if len(rows) <= MAX_LEAF:
+        return [rows]
+    with metrics.timer('kmeans'):
+        labels = spherical_kmeans(tfidf_matrix[rows], min(BRANCHING, len(rows)), rng)
+    parts = [rows[labels == c] for c in np.unique(labels)]
+    if len(parts) == 1:
+        #k-means could not tell the docs apart, like many copies of the same doc
+        parts = np.array_split(rows, math.ceil(len(rows) / MAX_LEAF))
+    return [leaf for part in parts for leaf in partition(tfidf_matrix, part, rng)]
+
+def cluster_large(tfidf_matrix, threshold, seed=0):
+    '''
+    scalable stand in for linkage and fcluster of every doc. returns the cluster of every
+    doc, numbered from 1 like fcluster, and the merges of all the parts in a linkage matrix:
+    merges come in order of distance, ids below num of docs are docs and num of docs + i is
+    the cluster made by merge i. distances are 1 - cosine similarity. memory is the tf-idf
+    matrix and the distances of one part
+    '''
+    from scipy.cluster.hierarchy import linkage, fcluster
+    from scipy.spatial.distance import squareform
+    num_docs = tfidf_matrix.shape[0]
+    rng = np.random.default_rng(seed)
+    leaves = partition(tfidf_matrix, np.arange(num_docs), rng)
+
+    clusters = np.zeros(num_docs, dtype=np.int32)
+    merges = [] #(distance, leaf, merge in the leaf, left, right, num of docs)
+    for leaf, rows in enumerate(leaves):
+        if len(rows) == 1:
+            clusters[rows] = clusters.max() + 1
+            continue
+        part = tfidf_matrix[rows]
+        with metrics.timer('leaf_linkage'):
+            distances = 1 - (part @ part.T).toarray()
+            np.fill_diagonal(distances, 0)
+            #rounding can make the distance of the same doc slightly negative
+            np.clip(distances, 0, None, out=distances)
+            Z_leaf = linkage(squareform(distances, checks=False), method='complete')
+        metrics.observe('leaf_docs', len(rows))
+        clusters[rows] = fcluster(Z_leaf, threshold, criterion='distance') + clusters.max()
+        for step, (left, right, distance, size) in enumerate(Z_leaf):
+            merges.append((distance, leaf, step, int(left), int(right), int(size)))
+
+    #complete linkage never merges at a smaller distance than before, so sorting keeps
+    #every merge after the merges of the clusters it joins
+    merges.sort(key=lambda merge: merge[:3])
+    node = {(leaf, step): num_docs + i for i, (_, leaf, step, _, _, _) in enumerate(merges)}
+    Z = np.empty((len(merges), 4))
+    for i, (distance, leaf, step, left, right, size) in enumerate(merges):
+        rows = leaves[leaf]
+        ids = [rows[child] if child < len(rows) else node[(leaf, child - len(rows))] for child in (left, right)]
+        Z[i] = (min(ids), max(ids), distance, size)
+    return clusters, Z
 
 if __name__ == "__main__":
+    from scipy.cluster.hierarchy import linkage, fcluster
+    from scipy.spatial.distance import squareform
+    from sklearn.metrics.pairwise import cosine_similarity
 
-    if len(sys.argv) < 2:
-        print("Use python3 clustering.py input-dir output-dir")
+    #--fast skips building the BeautifulSoup tree, --float32 halves the memory of the tf-idf matrix,
+    #--scalable clusters without the docs x docs matrix. --metrics prints the time of every
+    #stage at the end, --prometheus prints it for prometheus. --block-mb=n is about the MB of
+    #similarities computed at a time
+    fast = '--fast' in sys.argv
+    dtype = np.float32 if '--float32' in sys.argv else np.float64
+    scalable = '--scalable' in sys.argv
+    prometheus = '--prometheus' in sys.argv
+    metrics.enable('--metrics' in sys.argv or prometheus)
+    block_bytes = next((int(float(arg.split('=', 1)[1]) * 1024 * 1024) for arg in sys.argv
+                        if arg.startswith('--block-mb=')), BLOCK_BYTES)
+    args = [arg for arg in sys.argv if arg not in ('--fast', '--float32', '--scalable', '--metrics', '--prometheus')
+            and not arg.startswith('--block-mb=')]
+    if len(args) < 2:
+        print("Use python3 clustering.py input-dir output-dir [workers] [--fast] [--float32] [--scalable] "
+              "[--block-mb=n] [--metrics|--prometheus]")
 
-    input_dir = sys.argv[1]
-    output_dir = sys.argv[2]
+    input_dir = args[1]
+    output_dir = args[2]
+    workers = int(args[3]) if len(args) > 3 else WORKERS
 
     #reads in stop words
     with open('stopwords.txt', 'r') as f:
         stop_words_set = {line.strip() for line in f}
     
-    tf, df = parse(input_dir, stop_words_set)
-    tf_idf = tf_idf_matrix(tf,df)
+    with metrics.timer('parse'):
+        tf, df = parse(input_dir, stop_words_set, workers, fast)
+    with metrics.timer('tf_idf'):
+        tfidf_matrix, document_names = tf_idf_matrix(tf, df, dtype)
+    #the token counts are not needed once the matrix is built
+    del tf, df
 
-    tfidf_matrix = tf_idf.values  # convert DataFrame to numpy array
     num_docs = tfidf_matrix.shape[0]
-    #initialize an empty similarity matrix
-    similarity_matrix = np.zeros((num_docs, num_docs))
-    #for each pair of documents...constructing the similarity matrix
-    for i in range(num_docs):
-        for j in range(i+1, num_docs):  #only compute for j > i due to symmetry
-
-            #compute dot product
-            dot_product = np.dot(tfidf_matrix[i], tfidf_matrix[j])
-    
-            #compute cosine similarity and store in matrix
-            similarity_matrix[i, j] = dot_product
-            #ue to symmetry, similarity[i, j] is the same as similarity[j, i]
-            similarity_matrix[j, i] = similarity_matrix[i, j] #symmetry
-    #print(similarity_matrix)
-
-    distance_matrix = 1 - similarity_matrix
-    #print(distance_matrix)
-    Z = linkage(distance_matrix, method='complete')
     threshold = .4
-    clusters = fcluster(Z, threshold, criterion='distance')
+    if scalable:
+        with metrics.timer('cluster_large'):
+            clusters, Z = cluster_large(tfidf_matrix, threshold)
+        #the extremal pairs are searched a block of similarities at a time
+        blocks = similarity_blocks(tfidf_matrix, block_bytes)
+    else:
+        with metrics.timer('similarity'):
+            similarity = similarity_matrix(tfidf_matrix, block_bytes)
+        #print(similarity)
 
-    print(clusters)
+        distance_matrix = 1 - similarity
+        #print(distance_matrix)
+        #rounding can make the distance of the same doc slightly negative
+        np.clip(distance_matrix, 0, None, out=distance_matrix)
+        with metrics.timer('linkage'):
+            #linkage takes the condensed distances, a square matrix would be taken as docs
+            #with a vector of distances each. the diagonal is left out
+            Z = linkage(squareform(distance_matrix, checks=False), method='complete')
+            clusters = fcluster(Z, threshold, criterion='distance')
+        #the rows of the similarity matrix are searched as blocks without a copy
+        block_size = block_rows(num_docs, block_bytes)
+        blocks = ((start, similarity[start:start + block_size]) for start in range(0, num_docs, block_size))
 
-    document_names = tf_idf.index.tolist()
+    print(clusters)
 
     with open(os.path.join(output_dir, 'first_100.txt'), 'w') as f:
        
@@ -143,27 +465,14 @@ if __name__ == "__main__":
             
     # most_similar_pair = document_names[int(Z[0, 0])], document_names[int(Z[0, 1])]
     # print("Most similar pair:", most_similar_pair)
-    max_similarity = -1
-    most_similar_pair = ()
-    for i in range(num_docs):
-        for j in range(i+1, num_docs):
-            if similarity_matrix[i, j] > max_similarity:
-                max_similarity = similarity_matrix[i, j]
-                most_similar_pair = (i, j)
+    with metrics.timer('extremal_pairs'):
+        most_similar_pair, most_dissimilar_pair = extremal_pairs(blocks)
 
     #grabbing clusters which are most similar
     cluster_i = clusters[most_similar_pair[0]]  
     cluster_j = clusters[most_similar_pair[1]]
     print(f"\nMost similar pair of documents: {document_names[most_similar_pair[0]]}, {document_names[most_similar_pair[1]]}")
 
-    min_similarity = 1
-    most_dissimilar_pair = ()
-    for i in range(num_docs):
-        for j in range(i+1, num_docs):
-            if similarity_matrix[i, j] < min_similarity:
-                min_similarity = similarity_matrix[i, j]
-                most_dissimilar_pair = (i, j)
-
     #grabbing the clusters with most dissimilar
     cluster_x = clusters[most_dissimilar_pair[0]]
     cluster_y = clusters[most_dissimilar_pair[1]]
@@ -171,7 +480,10 @@ if __name__ == "__main__":
     print(f"\nMost dissimilar pair of documents: {document_names[most_dissimilar_pair[0]]}, {document_names[most_dissimilar_pair[1]]}")
 
     # Figuring out which one are closest to centroid
-    centroid = np.mean(tfidf_matrix, axis=0)
-    similarity_to_centroid = cosine_similarity(tfidf_matrix, centroid.reshape(1, -1))
+    #the centroid is dense but has one value per token, not per doc and token
+    centroid = np.asarray(tfidf_matrix.mean(axis=0))
+    similarity_to_centroid = cosine_similarity(tfidf_matrix, centroid)
     closest_to_centroid = document_names[np.argmax(similarity_to_centroid)]
-    print("\nClosest to centroid:", closest_to_centroid)
\ No newline at end of file
+    print("\nClosest to centroid:", closest_to_centroid)
+    if metrics.enabled:
+        print(metrics.dump(prometheus), end='')
@@ -0,0 +1,145 @@
+import time
+import math
+import threading
+from bisect import bisect_left
+
+#timers, counters and histograms of the stages of the pipeline. recording is off by
+#default and a stage then only pays for the check of enabled, the command lines turn it
+#on with --metrics for a text dump or --prometheus for the prometheus text format
+#
+#  with metrics.timer('tokenize'):         seconds of the stage go to the tokenize_seconds histogram
+#  metrics.count('docs')                   adds to a counter
+#  metrics.observe('doc_tokens', n)        adds a value to a histogram
+#
+#phase3, phase4 and phase5 have the same copy of this file
+
+enabled = False
+#upper bounds of the buckets of timers in seconds and of other histograms
+TIME_BUCKETS = (1e-6, 1e-5, 1e-4, 1e-3, 0.01, 0.1, 1.0, 10.0, 100.0)
+VALUE_BUCKETS = (1, 2, 5, 10, 100, 1000, 10000, 100000, 1000000)
+#prefix of the names in the prometheus dump
+PREFIX = 'ir_'
+
+counters = {}
+histograms = {}
+lock = threading.Lock()
+
+class Histogram:
+    '''
+    num of values up to every bucket bound plus count, sum, min and max
+    '''
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) #the last one is above every bound
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+def count(name, n=1):
+    if enabled:
+        with lock:
+            counters[name] = counters.get(name, 0) + n
+
+def observe(name, value, buckets=VALUE_BUCKETS):
+    if enabled:
+        with lock:
+            if name not in histograms:
+                histograms[name] = Histogram(buckets)
+            histograms[name].observe(value)
+
+class Timer:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.start, TIME_BUCKETS)
+
+class NoTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+NO_TIMER = NoTimer()
+
+def timer(name):
+    return Timer(name + '_seconds') if enabled else NO_TIMER
+
+def take():
+    '''
+    (counters, histograms) recorded so far, which are then cleared. worker
+    processes send them to the main process to merge
+    '''
+    global counters, histograms
+    with lock:
+        taken = counters, histograms
+        counters, histograms = {}, {}
+    return taken
+
+def merge(taken):
+    taken_counters, taken_histograms = taken
+    with lock:
+        for name, value in taken_counters.items():
+            counters[name] = counters.get(name, 0) + value
+        for name, histogram in taken_histograms.items():
+            if name in histograms:
+                histograms[name].merge(histogram)
+            else:
+                histograms[name] = histogram
+
+def dump_text():
+    lines = []
+    if histograms:
+        lines.append(f'{"histogram":<32}{"count":>10}{"sum":>14}{"mean":>14}{"min":>14}{"max":>14}')
+        for name, h in sorted(histograms.items()):
+            lines.append(f'{name:<32}{h.count:>10}{h.sum:>14.6g}{h.sum / h.count:>14.6g}{h.min:>14.6g}{h.max:>14.6g}')
+    if counters:
+        lines.append(f'{"counter":<32}{"value":>10}')
+        for name, value in sorted(counters.items()):
+            lines.append(f'{name:<32}{value:>10}')
+    return '\n'.join(lines) + '\n'
+
+def dump_prometheus():
+    lines = []
+    for name, value in sorted(counters.items()):
+        lines.append(f'# TYPE {PREFIX}{name}_total counter')
+        lines.append(f'{PREFIX}{name}_total {value}')
+    for name, h in sorted(histograms.items()):
+        lines.append(f'# TYPE {PREFIX}{name} histogram')
+        cumulative = 0
+        for bound, bucket_count in zip(h.buckets, h.counts):
+            cumulative += bucket_count
+            lines.append(f'{PREFIX}{name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{PREFIX}{name}_bucket{{le="+Inf"}} {h.count}')
+        lines.append(f'{PREFIX}{name}_sum {h.sum}')
+        lines.append(f'{PREFIX}{name}_count {h.count}')
+    return '\n'.join(lines) + '\n'
+
+def dump(prometheus=False):
+    return dump_prometheus() if prometheus else dump_text()